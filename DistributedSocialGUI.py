@@ -1,40 +1,304 @@
+import os
 import time
+import queue
+import functools
 import tkinter as tk
 from tkinter import Frame, ttk, simpledialog
+from tkinter import font as tkfont
+from concurrent.futures import ThreadPoolExecutor
 import ds_messenger as dsm
+import ds_endpoints
+import ds_store
+import ds_metrics
+from ds_metrics import profiled
+from ds_conversation import ConversationIndex
+from ds_outbox import OutboundQueue
+
+# The DSP server to log in to. Set DSP_SERVER and DSP_PORT to point the GUI at another server,
+# such as the local stand-in in ds_server.py. DSP_SERVER can list several host[:port] endpoints
+# separated by commas; they are raced at login and the fastest is remembered for the next one.
+DSP_SERVER = os.environ.get('DSP_SERVER', '168.235.86.101')
+DSP_PORT = os.environ.get('DSP_PORT', '2021')
+DSP_ENDPOINTS = ds_endpoints.parse_endpoints(DSP_SERVER, DSP_PORT)
+
+"""
+Runs DirectMessenger calls on a background thread so that the Tk event loop never waits on the network.
+A single thread is used so that requests sharing one socket are never interleaved.
+Results are handed back to the Tk thread by polling with root.after, and passed to the given callbacks there.
+"""
+class Worker:
+    POLL_MS = 50
+
+    def __init__(self, root):
+        self.root = root
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dsm-worker')
+        self._done = queue.Queue()
+        self.pending = 0
+        self.root.after(self.POLL_MS, self._drain)
+
+    """
+    Run func(*args) on the worker thread. callback receives the result and errback receives the
+    exception, both on the Tk thread.
+    """
+    def submit(self, func, *args, callback=None, errback=None):
+        self.pending += 1
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(lambda f: self._done.put(lambda: self._deliver(f, callback, errback)))
+        return future
+
+    """
+    Call callback(*args) on the Tk thread. Can be called from the worker thread to hand over partial
+    results while a call is still running.
+    """
+    def post(self, callback, *args):
+        self._done.put(lambda: callback(*args))
+
+    def _deliver(self, future, callback, errback):
+        self.pending -= 1
+        error = future.exception()
+        if error is not None:
+            if errback is not None:
+                errback(error)
+        elif callback is not None:
+            callback(future.result())
+
+    """
+    Run everything handed back by the worker thread, in order. Reschedules itself on the Tk event loop.
+    """
+    def _drain(self):
+        while True:
+            try:
+                deliver = self._done.get_nowait()
+            except queue.Empty:
+                break
+            deliver()
+        self.root.after(self.POLL_MS, self._drain)
+
+    """
+    Stop accepting work. Calls already running are left to finish on their own.
+    """
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+"""
+Polls the server for new messages in the background, through a Worker.
+The interval is short while the user is active and doubles after every empty poll, up to
+MAX_INTERVAL, so an idle window does not keep hammering the server.
+poll must return a (messages, size_in_bytes) pair; on_messages is called on the Tk thread
+with every non-empty result, and on_poll, if given, after every poll that reached the server.
+"""
+class Poller:
+    MIN_INTERVAL = 2000
+    MAX_INTERVAL = 60000
+
+    def __init__(self, root, worker, poll, on_messages, on_poll=None):
+        self.root = root
+        self.worker = worker
+        self._poll = poll
+        self._on_messages = on_messages
+        self._on_poll = on_poll
+        self.interval = self.MIN_INTERVAL
+        self.polls = 0
+        self.hits = 0
+        self.bytes = 0
+        self._after_id = None
+        self._in_flight = False
+
+    """
+    Start polling after the current interval.
+    """
+    def start(self):
+        self._schedule()
+
+    """
+    Stop polling. A poll already in flight still delivers its result.
+    """
+    def stop(self):
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+
+    """
+    Called when the user does something, so that new messages show up quickly again.
+    """
+    def activity(self):
+        if self.interval != self.MIN_INTERVAL:
+            self.interval = self.MIN_INTERVAL
+            if not self._in_flight:
+                self.stop()
+                self._schedule()
+
+    def _schedule(self):
+        self._after_id = self.root.after(self.interval, self._tick)
+
+    def _tick(self):
+        self._after_id = None
+        self._in_flight = True
+        self.worker.submit(self._poll, callback=self._on_result, errback=self._on_error)
+
+    def _on_result(self, result):
+        messages, size = result
+        self._in_flight = False
+        self.polls += 1
+        self.bytes += size
+        if messages:
+            self.hits += 1
+            self.interval = self.MIN_INTERVAL
+            self._on_messages(messages)
+        else:
+            self.interval = min(self.interval * 2, self.MAX_INTERVAL)
+        if self._on_poll is not None:
+            self._on_poll()
+        self._schedule()
+
+    def _on_error(self, error):
+        self._in_flight = False
+        self.polls += 1
+        self.interval = min(self.interval * 2, self.MAX_INTERVAL)
+        self._schedule()
+
+
+"""
+Convert a timestamp to a readable (day, time) pair. Results are cached, since the same
+messages are formatted again every time their conversation is opened.
+"""
+@functools.lru_cache(maxsize=65536)
+def format_timestamp(timestamp) -> tuple:
+    time_readable = time.localtime(timestamp)
+    day_str = f"{time_readable.tm_year}/{time_readable.tm_mon}/{time_readable.tm_mday}"
+    time_str = f"{time_readable.tm_hour}:{time_readable.tm_min}:{time_readable.tm_sec}"
+    return day_str, time_str
+
 
 """
 A subclass of tk.Frame that is responsible for drawing all of the widgets
 in the body portion of the root frame.
 """
 class Body(tk.Frame):
-    def __init__(self, root):
+    # Number of messages rendered at once in the entry_editor. Older pages are loaded on scroll-up.
+    PAGE_SIZE = 50
+
+    def __init__(self, root, search_callback=None):
         tk.Frame.__init__(self, root)
         self.root = root
+        self._search_callback = search_callback
         self._messages = []
         self._users = []
-        self._msg_dict = dict()
+        self._index = ConversationIndex()
+        self._msg_dict = self._index.as_dict()
+        self._unread = dict()
+        self._current = None
+        self._shown = 0
+        self._rendered = 0
+        self._last_rendered = None
+        self._loading_page = False
         # After all initialization is complete, call the _draw method to pack the widgets
         # into the Body instance 
         self._draw()
 
     """
-    Update the entry_editor with the full message entry when the corresponding node in the message_tree is selected.
+    Update the entry_editor with the message entries when the corresponding node in the message_tree is selected.
+    Only the latest page of the conversation is rendered; older pages are loaded when scrolling up.
     """
+    @profiled('gui.node_select')
     def node_select(self, event):
+        if not self.check_selection():
+            return
         self.entry_editor.delete(0.0, 'end')
-        index = int(self.message_tree.selection()[0])-1 #selections are not 0-based, so subtract one.
-        try:
-            key = self._users[index]
-            currt_user = self._msg_dict[key]
-            for i in reversed(range(len(currt_user))):
-                sent_day= self.convert_time(currt_user[i])[0]
-                sent_time = self.convert_time(currt_user[i])[1]
-                entry = currt_user[i]['message']
-                self.set_text_entry(entry, sent_day, sent_time, True)
-        except IndexError:
-            raise IndexError("list index out of range") 
+        self._current = self.get_current_username()
+        self._unread[self._current] = 0
+        self._update_row(self._current)
+        currt_user = self._msg_dict[self._current]
+        page = currt_user.latest(self.PAGE_SIZE)
+        self._shown = len(page)
+        self._rendered = len(currt_user)
+        self._last_rendered = page[-1].timestamp if page else None
+        self.entry_editor.insert('end', self._format_page(page))
+        self.entry_editor.see('end')
+
+    """
+    Render messages that arrived in the open conversation after it was rendered, below the ones shown.
+    Timestamps come from the sender's clock, so a message can also land between ones already shown;
+    then the page is rendered again instead.
+    """
+    def _render_tail(self):
+        currt_user = self._msg_dict[self._current]
+        new = len(currt_user) - self._rendered
+        if new <= 0:
+            return
+        tail = currt_user.latest(new)
+        # Everything rendered so far is no newer than _last_rendered, so the `new` latest messages
+        # are exactly the added ones only if they are all newer than it.
+        if self._last_rendered is not None and tail[0].timestamp <= self._last_rendered:
+            self.node_select(None)
+            return
+        self.entry_editor.insert('end', self._format_page(tail))
+        self._shown += new
+        self._rendered = len(currt_user)
+        self._last_rendered = tail[-1].timestamp
+        self.entry_editor.see('end')
+
+    """
+    Render the page of messages just before the ones shown at the top of the entry_editor,
+    keeping the view where it was.
+    """
+    def _load_older_page(self):
+        self._loading_page = False
+        if self._current is None:
+            return
+        older = self._msg_dict[self._current].latest(self.PAGE_SIZE, self._shown)
+        if not older:
+            return
+        page = self._format_page(older)
+        self._shown += len(older)
+        lines = page.count('\n')
+        self.entry_editor.insert('1.0', page)
+        self.entry_editor.yview(f"{lines + 1}.0")
+
+    """
+    Build the text of a list of messages so it can be inserted into the entry_editor at once.
+    """
+    def _format_page(self, messages: list) -> str:
+        parts = []
+        for msg in messages:
+            sent_day, sent_time = format_timestamp(msg.timestamp)
+            sent_by = ' (you)' if msg.outgoing else ''
+            parts.append(sent_day + ' ' + sent_time + sent_by + '\n' + msg.body + '\n\n')
+        return ''.join(parts)
+
+    """
+    Update the scrollbar, and load an older page once the top of the entry_editor is reached.
+    """
+    def _on_entry_scroll(self, first, last):
+        self.entry_editor_scrollbar.set(first, last)
+        if (float(first) <= 0.0 and self._current is not None and not self._loading_page
+                and self._shown < len(self._msg_dict[self._current])):
+            self._loading_page = True
+            self.after_idle(self._load_older_page)
     
+    """
+    Call the callback function specified in the search_callback class attribute, if
+    available, with the text of the search_entry when a search is requested.
+    """
+    def search_click(self, event=None):
+        query = self.search_entry.get().strip()
+        if query and self._search_callback is not None:
+            self._search_callback(query)
+
+    """
+    Show search hits in the entry_editor, each with its sender and timestamp.
+    """
+    def show_search_results(self, query: str, hits: list):
+        self._current = None
+        self.message_tree.selection_set(())
+        parts = [f"{len(hits)} result(s) for '{query}':\n\n"]
+        for msg in hits:
+            sent_day, sent_time = format_timestamp(msg.timestamp)
+            who = f'you to {msg.recipient}' if msg.outgoing else msg.sender
+            parts.append(f'{sent_day} {sent_time} {who}\n{msg.body}\n\n')
+        self.entry_editor.delete(0.0, 'end')
+        self.entry_editor.insert('end', ''.join(parts))
+
     """
     Check if the node is selected, return the current selection.
     """
@@ -42,40 +306,25 @@ class Body(tk.Frame):
         return self.message_tree.selection() != ()
 
     """
-    Get current username when selected. 
+    Get current username when selected. Rows of the message_tree are keyed by username.
     """
     def get_current_username(self):
-        index = int(self.message_tree.selection()[0])-1 #selections are not 0-based, so subtract one.
-        return self._users[index]
+        return self.message_tree.selection()[0]
 
     """
     Convert timestamp to readable ones.
     """
     def convert_time(self, message) -> str:
-        time_readable = time.localtime(float(message['timestamp']))
-        day_str = f"{time_readable.tm_year}/{time_readable.tm_mon}/{time_readable.tm_mday}"
-        time_str = f"{time_readable.tm_hour}:{time_readable.tm_min}:{time_readable.tm_sec}"
-        return day_str, time_str
+        return format_timestamp(message.timestamp)
 
     """
     Combine all the messages sent by one user under the same username, 
-    instead of listing them separately.
+    instead of listing them separately. Builds the conversation index in a single pass;
+    users are listed in the order they first appeared.
     """
     def combine_user(self):
-        user_name = []
-        for message in self._messages:
-            user_name.append(message['from'])
-        
-        user_dict = dict.fromkeys(user_name)
-        for user in user_name:
-            user_dict[user] = []
-            for msg in self._messages:
-                curr_user = msg['from']
-                if curr_user == user:
-                    new = msg.copy()
-                    del new['from']
-                    user_dict[user].append(new)
-        return list(set(user_name)), user_dict
+        self._index = ConversationIndex(self._messages)
+        return self._index.users(), self._index.as_dict()
     
     """
     Return the text that is currently displayed in the entry_editor widget.
@@ -113,34 +362,118 @@ class Body(tk.Frame):
                 self.entry_editor.insert(tk.END, text + '\n')
     
     """
-    Get all the users who have sent us messages and list them only once under the treeview widget.
+    Get all the users who have sent us messages and list them only once under the treeview widget,
+    most recently active first.
     """
+    @profiled('gui.set_users')
     def set_users(self, message_all: list):
         self._messages = message_all
         res = self.combine_user()
         self._users = res[0]
         self._msg_dict = res[1]
 
-        for idx, user in enumerate(self._users):
-            self._insert_msg_tree(idx+1, user, True)
+        self.message_tree.delete(*self.message_tree.get_children())
+        self._unread.clear()
+
+        by_activity = sorted(self._users, key=lambda user: self._msg_dict[user].last_activity or 0, reverse=True)
+        for user in by_activity:
+            self._unread[user] = 0
+            self._insert_msg_tree('end', user, True)
     
+    """
+    Merge newly arrived messages into the conversation index without regrouping the history.
+    The rows of the users involved are inserted or moved to the top of the message_tree, one row
+    each, in order of last activity. Returns a dict of the users whose conversations changed to the
+    number of messages each received.
+    """
+    def add_messages(self, messages: list) -> dict:
+        self._messages.extend(messages)
+        touched = self._index.extend(messages)
+        for user in sorted(touched, key=lambda user: self._msg_dict[user].last_activity):
+            self._upsert_user(user)
+        return touched
+
+    """
+    Redraw the parts of the view that changed for the given users: the open conversation is
+    rendered again and, unless unread is false, the unread counters of the other users go up by
+    the number of new messages.
+    """
+    def refresh(self, users: dict, unread: bool = True):
+        current = self.get_current_username() if self.check_selection() else None
+        for user in users:
+            if user == current:
+                self._render_tail()
+            elif unread:
+                self._unread[user] += users[user]
+                self._update_row(user)
+
+    """
+    Take messages back out of the conversation index, and render the open conversation again if
+    it lost any of them.
+    """
+    def remove_messages(self, messages: list):
+        touched = self._index.remove(messages)
+        if not touched:
+            return
+        kept = {id(msg) for user in touched for msg in self._msg_dict[user]}
+        self._messages = [msg for msg in self._messages if msg.peer not in touched or id(msg) in kept]
+        current = self.get_current_username() if self.check_selection() else None
+        if current in touched:
+            self.node_select(None)
+
+    """
+    Start an empty conversation with a user and list it in the message_tree.
+    Returns false if there already is a conversation with that user.
+    """
+    def add_conversation(self, username) -> bool:
+        if not self._index.add_user(username):
+            return False
+        self._upsert_user(username)
+        return True
+
     """
     Insert a single new username into the message_tree.
     """
     def insert_msg(self, new_username):
-        self._insert_msg_tree(len(self._users), new_username, True)
+        self._upsert_user(new_username)
+
+    """
+    Insert the row of a user at the top of the message_tree, or move it there if it already exists.
+    """
+    def _upsert_user(self, username):
+        if username in self._unread:
+            self.message_tree.move(username, '', 0)
+        else:
+            self._users.append(username)
+            self._unread[username] = 0
+            self._insert_msg_tree(0, username, True)
+
+    """
+    Update the label and the unread mark of a user's row.
+    """
+    def _update_row(self, username):
+        count = self._unread[username]
+        self.message_tree.item(username, text=self._row_label(username, count),
+                               tags=('unread',) if count else ())
+
+    """
+    The text of a user's row: the username, shortened if needed, and the unread count.
+    """
+    def _row_label(self, username, unread: int = 0) -> str:
+        if len(username) > 25:
+            username = username[:24] + '...'
+        return f'{username} ({unread})' if unread else username
     
     """
-    Insert a username into the message_tree widget, distinguished between old and new usernames.
+    Insert a username into the message_tree widget at index, distinguished between old and new usernames.
+    The row is keyed by the full username.
     """
-    def _insert_msg_tree(self, id, msg, new:bool=None):
+    def _insert_msg_tree(self, index, msg, new:bool=None):
         if not new:
-            username = msg['from']
+            username = msg.sender
         else:
             username = msg
-        if len(username) > 25:
-            username = username[:24] + '...'
-        self.message_tree.insert('', id, id, text=username)
+        self.message_tree.insert('', index, iid=username, text=self._row_label(username))
     
     """
     Call only once upon initialization to add widgets to the frame
@@ -148,8 +481,18 @@ class Body(tk.Frame):
     def _draw(self):
         posts_frame = tk.Frame(master=self, width=250)
         posts_frame.pack(fill=tk.BOTH, side=tk.LEFT)
+
+        search_frame = tk.Frame(master=posts_frame)
+        search_frame.pack(fill=tk.X, side=tk.TOP, padx=5, pady=(5, 0))
+        self.search_entry = tk.Entry(search_frame)
+        self.search_entry.bind('<Return>', self.search_click)
+        self.search_entry.pack(fill=tk.X, side=tk.LEFT, expand=True)
+        tk.Button(master=search_frame, text="Search", command=self.search_click).pack(side=tk.RIGHT)
         self.message_tree = ttk.Treeview(posts_frame)
         self.message_tree.bind("<<TreeviewSelect>>", self.node_select)
+        unread_font = tkfont.nametofont('TkDefaultFont').copy()
+        unread_font.configure(weight='bold')
+        self.message_tree.tag_configure('unread', font=unread_font)
         self.message_tree.pack(fill=tk.BOTH, side=tk.TOP, expand=True, padx=5, pady=5)
 
         entry_frame = tk.Frame(master=self, bg="")
@@ -170,9 +513,9 @@ class Body(tk.Frame):
         self.entry_editor = tk.Text(editor_frame, width=0, height=5, bg='#efefef')
         self.entry_editor.pack(fill=tk.BOTH, side=tk.LEFT, expand=True, padx=0, pady=0)
 
-        entry_editor_scrollbar = tk.Scrollbar(master=scroll_frame, command=self.entry_editor.yview)
-        self.entry_editor['yscrollcommand'] = entry_editor_scrollbar.set
-        entry_editor_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
+        self.entry_editor_scrollbar = tk.Scrollbar(master=scroll_frame, command=self.entry_editor.yview)
+        self.entry_editor['yscrollcommand'] = self._on_entry_scroll
+        self.entry_editor_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
 
 
 """
@@ -210,6 +553,15 @@ class Footer(tk.Frame):
     def set_status(self, message):
         self.footer_label.configure(text=message)
 
+    """
+    Show how many messages are waiting in the outbound queue and how long the oldest has waited.
+    """
+    def set_queue(self, depth: int, age: float = None):
+        if depth:
+            self.queue_label.configure(text=f'Queued: {depth} (oldest {age:.0f}s)')
+        else:
+            self.queue_label.configure(text='')
+
     """
     Call only once upon initialization to add widgets to the frame
     """
@@ -225,6 +577,9 @@ class Footer(tk.Frame):
         self.footer_label = tk.Label(master=self, text="Ready.")
         self.footer_label.pack(fill=tk.BOTH, side=tk.LEFT, padx=5)
 
+        self.queue_label = tk.Label(master=self, text="")
+        self.queue_label.pack(fill=tk.BOTH, side=tk.RIGHT, padx=5)
+
 
 """
 A subclass of tk.Frame that is responsible for drawing all of the widgets
@@ -232,23 +587,117 @@ in the main portion of the root frame. Also manages all method calls for
 the DirectMessenger class.
 """
 class MainApp(tk.Frame):
-    def __init__(self, root, username, password, connection):
+    # Delay in milliseconds before retrying a flush of the outbound queue after a failure.
+    FLUSH_RETRY_MIN = 2000
+    FLUSH_RETRY_MAX = 60000
+
+    def __init__(self, root, username, password, connection, worker=None, store=None, started=None):
         tk.Frame.__init__(self, root)
         self.root = root
         self.username = username
         self.password = password
         self.connect = connection
+        self.worker = worker if worker is not None else Worker(root)
+        self.store = store if store is not None else ds_store.MessageStore()
+        # Keyed by the configured server rather than the endpoint that won the race, so the
+        # cached history is shared by all of them.
+        self.account = ds_store.account_key(username, DSP_SERVER)
+        self.outbox = OutboundQueue(self.store, self.account)
+        self.connect.attach_store(self.store, self.account)
+        self._flushing = False
+        self._flush_retry = self.FLUSH_RETRY_MIN
+        self._flush_after_id = None
+        self._queue_after_id = None
         self._is_select = False
-        self.all_msg = self.connect.retrieve_all()
+        self._started = started if started is not None else time.perf_counter()
+        self._first_render = False
         
         # After all initialization is complete, call the _draw method to pack the widgets
         # into the root frame
         self._draw()
-        self.body.set_users(self.all_msg)
+        self.all_msg = self.body._messages
+        self.root.after_idle(self._on_interactive)
+
+        # The window is usable from here on. The history is filled in progressively, first from the
+        # local store and then from the server, in batches handed over by the worker thread.
+        self.footer.set_status('Loading messages...')
+        seeded = self.store.is_seeded(self.account)
+        if seeded:
+            # Only the rows already stored now: messages sent meanwhile are added to the view by send_msg.
+            self.worker.submit(self._load_cache, self.store.last_id(), errback=self._on_error)
+        self.worker.submit(self.store.sync, self.account, self.connect,
+                           lambda batch: self.worker.post(self._on_history_batch, batch, seeded),
+                           callback=self._on_sync, errback=self._on_error)
+        self.poller = Poller(self.root, self.worker, self._poll, self._on_new_messages, self._on_poll)
+        self.body.message_tree.bind("<<TreeviewSelect>>", lambda event: self.poller.activity(), add='+')
+        self.poller.start()
+        self._update_queue()
+        if self.outbox.depth():
+            self._flush_outbox()
+
+    """
+    Record the time from the login click until the main window is drawn and accepting input.
+    """
+    def _on_interactive(self):
+        ds_metrics.metrics.observe('startup.time_to_interactive', time.perf_counter() - self._started)
+
+    """
+    Hand the messages held in the local store, up to row until, to the Tk thread in batches.
+    Runs on the worker thread.
+    """
+    def _load_cache(self, until):
+        for batch in self.store.load_batches(self.account, until=until):
+            self.worker.post(self._on_history_batch, batch, False)
+
+    """
+    Merge a batch of history into the conversations as it arrives. Batches from an incremental sync
+    are new to the user and mark their conversations unread.
+    """
+    def _on_history_batch(self, batch, unread):
+        self.body.refresh(self.body.add_messages(batch), unread)
+        if not self._first_render:
+            self._first_render = True
+            ds_metrics.metrics.observe('startup.first_render', time.perf_counter() - self._started)
+
+    """
+    The sync with the server has finished and every batch has been merged.
+    """
+    def _on_sync(self, added):
+        self.footer.set_status('Ready.')
+        ds_metrics.metrics.observe('startup.history_complete', time.perf_counter() - self._started)
+
+    """
+    Fetch new messages from the server and add them to the local store. Runs on the worker thread.
+    """
+    def _poll(self):
+        added = self.store.sync(self.account, self.connect)
+        return added, self.connect.server_connect.last_read_size
+
+    """
+    The server answered a poll, so a flush waiting for a retry after a failure can go now.
+    """
+    def _on_poll(self):
+        if self._flush_after_id is not None:
+            self._flush_outbox()
+
+    """
+    Merge messages found by the poller and redraw only the conversations they belong to.
+    """
+    def _on_new_messages(self, added):
+        self.body.refresh(self.body.add_messages(added))
+        self.footer.set_status(f'{len(added)} new message(s).')
+
+    """
+    Show an exception raised on the worker thread in the footer.
+    """
+    def _on_error(self, error):
+        self.footer.set_status(error)
 
     """
     Send direct messages to another user, asking for username if necessay.
+    The message goes through the session opened at login instead of a new connection.
     """
+    @profiled('gui.send_msg')
     def send_msg(self):
         msg = self.body.get_message_entry()
         if msg == '':
@@ -260,29 +709,113 @@ class MainApp(tk.Frame):
             recipient = simpledialog.askstring('Ask recipient', "Recipient:")   
         else:
             recipient = self.body.get_current_username()
-        
-        try:
-                user = dsm.DirectMessenger("168.235.86.101", self.username, self.password)
-                user.send(msg, recipient)
-                self.footer.set_status('Message successfully sent!')
-        except Exception as e:
-            self.footer.set_status(e)
+        if not recipient:
+            self.footer.set_status('Error: No recipient!')
+            return
+
+        self.poller.activity()
+        sent = dsm.Message(self.username, time.time(), msg, recipient)
+        self.outbox.enqueue(msg, recipient, sent.timestamp)
+        self.store.add_messages(self.account, [sent])
+        self.body.refresh(self.body.add_messages([sent]), unread=False)
+        self.footer.set_status('Sending...')
         self.body.set_message_entry("")
+        self._update_queue()
+        self._flush_outbox()
+
+    """
+    Send everything in the outbound queue on the worker thread, unless a flush is already running.
+    """
+    def _flush_outbox(self):
+        if self._flush_after_id is not None:
+            self.root.after_cancel(self._flush_after_id)
+            self._flush_after_id = None
+        if self._flushing:
+            return
+        self._flushing = True
+        self.worker.submit(self.outbox.flush, self.connect, callback=self._on_flush, errback=self._on_flush_error)
+
+    """
+    Report the result of a flush once the server has answered, and flush again if more was queued meanwhile.
+    """
+    def _on_flush(self, result):
+        sent, rejected = result
+        self._flushing = False
+        self._flush_retry = self.FLUSH_RETRY_MIN
+        if rejected:
+            self._drop_rejected(rejected)
+            self.footer.set_status(f'Error: {len(rejected)} message(s) rejected by the server and removed.')
+        elif sent:
+            self.footer.set_status(f'Message successfully sent! ({self.connect.last_latency * 1000:.0f} ms)')
+        self._update_queue()
+        if self.outbox.depth():
+            self._flush_outbox()
+
+    """
+    Take messages the server rejected back out of the store and the conversations. They were shown
+    and stored as sent when they were queued. rejected holds (recipient, message, timestamp) rows.
+    """
+    def _drop_rejected(self, rejected):
+        failed = [dsm.Message(self.username, timestamp, message, recipient)
+                  for recipient, message, timestamp in rejected]
+        self.store.remove_messages(self.account, failed)
+        self.body.remove_messages(failed)
+
+    """
+    Keep the messages queued when the server cannot be reached, and try again later with a growing delay.
+    """
+    def _on_flush_error(self, error):
+        self._flushing = False
+        # The server may have answered part of the queue before the connection failed.
+        sent, rejected = getattr(error, 'flushed', ((), ()))
+        if rejected:
+            self._drop_rejected(rejected)
+        self.footer.set_status(f'Offline, message queued: {error}')
+        self._update_queue()
+        self._flush_after_id = self.root.after(self._flush_retry, self._flush_outbox)
+        self._flush_retry = min(self._flush_retry * 2, self.FLUSH_RETRY_MAX)
+
+    """
+    Refresh the queue depth and age in the footer, every second while anything is queued.
+    """
+    def _update_queue(self):
+        if self._queue_after_id is not None:
+            self.root.after_cancel(self._queue_after_id)
+            self._queue_after_id = None
+        depth = self.outbox.depth()
+        self.footer.set_queue(depth, self.outbox.oldest_age())
+        if depth:
+            self._queue_after_id = self.root.after(1000, self._update_queue)
     
+    """
+    Search the local message history and show the hits in the entry_editor.
+    """
+    def search(self, query):
+        start = time.perf_counter()
+        hits = self.connect.search(query)
+        self.body.show_search_results(query, hits)
+        self.footer.set_status(f'{len(hits)} result(s) in {(time.perf_counter() - start) * 1000:.0f} ms')
+
     """
     Add a new user to send direct messages to.
     """
     def add_user(self):
         new_user = simpledialog.askstring('Ask new username', "Username:")
-        self.body._users.append(new_user)
-        self.body.insert_msg(new_user)
-        self.footer.set_status('New user successfully added!')
-        self.body._msg_dict[new_user] = ""
+        if not new_user or not new_user.strip():
+            self.footer.set_status('Error: No username!')
+            return
+        if self.body.add_conversation(new_user.strip()):
+            self.footer.set_status('New user successfully added!')
+        else:
+            self.footer.set_status(f'{new_user.strip()} is already in your conversations.')
 
     """
     Close the program when the 'Close' menu item is clicked.
     """
     def close(self):
+        self.poller.stop()
+        self.worker.shutdown()
+        self.store.close()
         self.root.destroy()
 
     """
@@ -290,7 +823,7 @@ class MainApp(tk.Frame):
     """
     def _draw(self):
 
-        self.body = Body(self.root)
+        self.body = Body(self.root, search_callback=self.search)
         self.body.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
         
         self.footer = Footer(self.root, send_callback=self.send_msg, add_callback=self.add_user)
@@ -308,6 +841,8 @@ class LoginPage(tk.Frame):
         self.root = root
         self.username = tk.StringVar() 
         self.password = tk.StringVar()
+        self.worker = Worker(root)
+        self._logging_in = False
         self._draw()
 
     """
@@ -316,22 +851,40 @@ class LoginPage(tk.Frame):
     def login_check(self):
         username = self.username.get()
         password = self.password.get()
+        if self._logging_in:
+            return
         
-        try:
-            dsm_object = dsm.DirectMessenger("168.235.86.101", username, password)
-        except Exception as e:
-            self.error_label.configure(text=e, fg='red')
-            
-        else:
-            self.loginpage.destroy()
-            self.root.geometry("720x480")
-            
-            MainApp(self.root, username, password, dsm_object)
+        self._logging_in = True
+        self._login_started = time.perf_counter()
+        self.error_label.configure(text='Connecting...', fg='black')
+        connect = functools.partial(dsm.DirectMessenger, username=username, password=password,
+                                    endpoints=DSP_ENDPOINTS, endpoint_cache=ds_endpoints.EndpointCache())
+        self.worker.submit(connect,
+                           callback=lambda dsm_object: self._on_login(username, password, dsm_object),
+                           errback=self._on_login_error)
+
+    """
+    Replace the login page with the main window once the server has accepted the login.
+    """
+    def _on_login(self, username, password, dsm_object):
+        ds_metrics.metrics.observe('startup.join', time.perf_counter() - self._login_started)
+        self.loginpage.destroy()
+        self.root.geometry("720x480")
+        
+        MainApp(self.root, username, password, dsm_object, self.worker, started=self._login_started)
+
+    """
+    Show the reason the login failed and allow another attempt.
+    """
+    def _on_login_error(self, error):
+        self._logging_in = False
+        self.error_label.configure(text=error, fg='red')
     
     """
     Close the program when the 'Exit' menu item is clicked.
     """
     def close(self):
+        self.worker.shutdown()
         self.root.destroy()
 
     """
@@ -368,6 +921,11 @@ if __name__ == "__main__":
     # If you're curious, feel free to comment out and see how the menu changes.
     main.option_add('*tearOff', False)
 
+    # Set DSP_METRICS_FILE to have the client metrics written to that file every 10 seconds,
+    # and DSP_PROFILE to also time the GUI handlers.
+    if os.environ.get('DSP_METRICS_FILE'):
+        ds_metrics.metrics.start_dump(os.environ['DSP_METRICS_FILE'], 10)
+
     # Initialize the LoginPage class, which is the starting point for the widgets used in the program.
     LoginPage(main)
 
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import ds_messenger as dsm
+from ds_conversation import ConversationIndex
+
+"""
+The history sizes benchmarked by default.
+"""
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+"""
+Return the p-th percentile of a list of numbers, using the nearest-rank method.
+"""
+def percentile(values:list, p:float) -> float:
+  ordered = sorted(values)
+  if not ordered:
+    return None
+  rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+  return ordered[rank]
+
+
+"""
+Start ds_server.py in a subprocess on a free loopback port and return (process, port).
+The server runs in its own process so that its memory is not counted in the client measurements.
+"""
+def start_server(history_size:int, senders:int, latency:float=0.0):
+  server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ds_server.py')
+  proc = subprocess.Popen(
+    [sys.executable, server, '--port', '0', '--history', str(history_size), '--senders', str(senders),
+     '--latency', str(latency)],
+    stdout=subprocess.PIPE, text=True)
+  line = proc.stdout.readline()
+  return proc, line.rsplit(':', 1)[1].strip()
+
+
+"""
+Time a call, returning (result, seconds).
+"""
+def timed(func, *args):
+  start = time.perf_counter()
+  result = func(*args)
+  return result, time.perf_counter() - start
+
+
+"""
+Create a hidden Tk root for the GUI benchmarks, or return None when no display is available.
+"""
+def _tk_root():
+  try:
+    import tkinter as tk
+    root = tk.Tk()
+  except Exception:
+    return None
+  root.withdraw()
+  return root
+
+
+"""
+Benchmark the GUI-side handlers on an already retrieved history.
+"""
+def bench_gui(root, messages:list) -> dict:
+  import DistributedSocialGUI as gui
+  body = gui.Body(root)
+  _, set_users = timed(body.set_users, messages)
+  root.update_idletasks()
+
+  busiest = max(body._users, key=lambda user: len(body._msg_dict[user]))
+  body.message_tree.selection_set(busiest)
+  root.update()
+  _, node_select = timed(body.node_select, None)
+  root.update_idletasks()
+  body.destroy()
+  return {'set_users_s': set_users, 'node_select_s': node_select}
+
+
+"""
+Run every benchmark against a history of `size` messages spread over `senders` senders.
+"""
+def bench_size(size:int, senders:int, sends:int, root=None) -> dict:
+  proc, port = start_server(size, senders)
+  try:
+    result = {'messages': size, 'senders': senders}
+    username = f'bench{size}'
+
+    tracemalloc.start()
+    login_start = time.perf_counter()
+    messenger = dsm.DirectMessenger('127.0.0.1', username, 'password', port)
+    result['join_s'] = time.perf_counter() - login_start
+
+    messages, result['retrieve_all_s'] = timed(messenger.retrieve_all)
+    index, result['combine_user_s'] = timed(ConversationIndex, messages)
+    result['login_to_first_render_s'] = time.perf_counter() - login_start
+    result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    if root is not None:
+      result.update(bench_gui(root, messages))
+      result['login_to_first_render_s'] += result['set_users_s']
+    del messages, index
+
+    stream_start = time.perf_counter()
+    result['streamed_messages'] = sum(1 for _ in messenger.iter_all())
+    result['iter_all_s'] = time.perf_counter() - stream_start
+
+    latencies = []
+    send_start = time.perf_counter()
+    for i in range(sends):
+      messenger.send(f'bench {i}', 'sink')
+      latencies.append(messenger.last_latency)
+    elapsed = time.perf_counter() - send_start
+    result['send_per_s'] = sends / elapsed
+    result['send_latency_ms'] = {f'p{p}': percentile(latencies, p) * 1000 for p in (50, 90, 99)}
+
+    _, elapsed = timed(messenger.send_many, [(f'bench {i}', 'sink') for i in range(sends)])
+    result['send_many_per_s'] = sends / elapsed
+    messenger.close()
+    return result
+  finally:
+    proc.terminate()
+    proc.wait()
+
+
+"""
+Print how each numeric result changed relative to a previous run.
+"""
+def compare(results:dict, baseline:dict):
+  old_runs = {run['messages']: run for run in baseline['runs']}
+  for run in results['runs']:
+    old = old_runs.get(run['messages'])
+    if old is None:
+      continue
+    for key, value in run.items():
+      if isinstance(value, float) and old.get(key):
+        print(f"{run['messages']:>7} {key:<26} {value / old[key]:6.2f}x")
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the messenger client hot paths against a local server.')
+  parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='history sizes to benchmark')
+  parser.add_argument('--senders', type=int, default=200, help='number of senders in each history')
+  parser.add_argument('--sends', type=int, default=1000, help='messages sent for the throughput and latency runs')
+  parser.add_argument('--output', default='bench_results.json', help='file the JSON results are written to')
+  parser.add_argument('--compare', help='earlier results file to compare against')
+  parser.add_argument('--no-gui', action='store_true', help='skip the Tk benchmarks')
+  args = parser.parse_args()
+
+  root = None if args.no_gui else _tk_root()
+  results = {
+    'timestamp': time.time(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'gui': root is not None,
+    'runs': [],
+  }
+  for size in args.sizes:
+    run = bench_size(size, args.senders, args.sends, root)
+    results['runs'].append(run)
+    print(json.dumps(run))
+
+  with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      compare(results, json.load(f))
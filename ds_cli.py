@@ -0,0 +1,231 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import ds_endpoints
+import ds_messenger as dsm
+
+"""
+A headless command line client for the DSP server, for scripts and batch jobs.
+`send` streams messages from a file or stdin over one pipelined connection, and `all` and `new`
+write the retrieved messages to stdout as NDJSON, one message dict per line.
+Only ds_messenger is imported, never tkinter, so the client starts quickly on machines without a display.
+"""
+
+DSP_SERVER = os.environ.get('DSP_SERVER', '168.235.86.101')
+DSP_PORT = os.environ.get('DSP_PORT', '2021')
+
+"""
+The number of messages written back-to-back before their responses are read.
+"""
+BATCH_SIZE = 100
+
+
+"""
+Raised for an input row that cannot be turned into a message.
+"""
+class RowError(ValueError):
+  pass
+
+
+"""
+Turn one JSON row into a (message, recipient, timestamp) triple. The message is read from
+"message" or "entry"; the timestamp is optional and defaults to now.
+"""
+def _json_row(line:str) -> tuple:
+  try:
+    row = json.loads(line)
+  except ValueError as e:
+    raise RowError(f'invalid JSON: {e}')
+  if not isinstance(row, dict):
+    raise RowError('expected a JSON object')
+  message = row.get('message', row.get('entry'))
+  recipient = row.get('recipient')
+  if not isinstance(message, str) or not isinstance(recipient, str) or not recipient:
+    raise RowError('needs a "recipient" and a "message"')
+  return message, recipient, _timestamp(row.get('timestamp'))
+
+
+"""
+Turn one CSV row of recipient,message[,timestamp] into a (message, recipient, timestamp) triple.
+"""
+def _csv_row(row:list) -> tuple:
+  if len(row) < 2 or not row[0]:
+    raise RowError('expected recipient,message[,timestamp]')
+  return row[1], row[0], _timestamp(row[2] if len(row) > 2 and row[2] else None)
+
+
+def _timestamp(value) -> float:
+  if value is None:
+    return time.time()
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    raise RowError(f'invalid timestamp {value!r}')
+
+
+"""
+Yield (line number, triple or RowError) for every message in a file of JSON or CSV rows.
+With fmt 'auto', a file whose first non-blank character is '{' is read as JSON lines, anything
+else as CSV. A CSV header row starting with "recipient" is skipped.
+"""
+def read_rows(f, fmt:str='auto'):
+  lines = iter(f)
+  head = []
+  if fmt == 'auto':
+    fmt = 'csv'
+    for line in lines:
+      head.append(line)
+      if line.strip():
+        fmt = 'json' if line.lstrip().startswith('{') else 'csv'
+        break
+  lines = itertools.chain(head, lines)
+
+  if fmt == 'json':
+    for number, line in enumerate(lines, 1):
+      if not line.strip():
+        continue
+      try:
+        yield number, _json_row(line)
+      except RowError as e:
+        yield number, e
+  else:
+    reader = csv.reader(lines)
+    for row in reader:
+      if not row or (reader.line_num == 1 and row[0].strip().lower() == 'recipient'):
+        continue
+      try:
+        yield reader.line_num, _csv_row(row)
+      except RowError as e:
+        yield reader.line_num, e
+
+
+"""
+Send every row of f in pipelined batches and return (sent, failed, seconds).
+Rows that cannot be parsed and messages the server rejects are reported on err as they happen.
+If the connection fails or times out, the messages the server answered are counted as usual, the
+rest of the batch as failed, and the rows after it are not sent.
+"""
+def send_rows(messenger, f, fmt:str='auto', batch_size:int=BATCH_SIZE, err=sys.stderr) -> tuple:
+  sent = failed = 0
+  start = time.perf_counter()
+  batch = []
+
+  def flush() -> bool:
+    nonlocal sent, failed
+    error = None
+    try:
+      results = messenger.send_many([row for _, row in batch], batch_size)
+    except (OSError, ValueError, dsm.ServerTimeoutError) as e:
+      error = e
+      results = getattr(e, 'answered', [])
+    for (number, (_, recipient, _)), ok in zip(batch, results):
+      if ok:
+        sent += 1
+      else:
+        failed += 1
+        print(f'line {number}: rejected by the server (to {recipient})', file=err)
+    if error is not None:
+      unanswered = batch[len(results):]
+      failed += len(unanswered)
+      if unanswered:
+        print(f'line {unanswered[0][0]}: not sent ({error}), stopping', file=err)
+      else:
+        print(f'connection lost ({error}), stopping', file=err)
+    batch.clear()
+    return error is None
+
+  for number, row in read_rows(f, fmt):
+    if isinstance(row, RowError):
+      failed += 1
+      print(f'line {number}: {row}', file=err)
+      continue
+    batch.append((number, row))
+    if len(batch) >= batch_size and not flush():
+      break
+  else:
+    if batch:
+      flush()
+  return sent, failed, time.perf_counter() - start
+
+
+"""
+Write the messages yielded by messages to out as NDJSON and return how many were written.
+"""
+def dump(messages, out=sys.stdout) -> int:
+  count = 0
+  for msg in messages:
+    out.write(json.dumps(msg.to_dict()))
+    out.write('\n')
+    count += 1
+  out.flush()
+  return count
+
+
+def _parser() -> argparse.ArgumentParser:
+  parser = argparse.ArgumentParser(description='Send and retrieve DSP direct messages without the GUI.')
+  parser.add_argument('--server', default=DSP_SERVER,
+                      help='DSP server host, or several host[:port] endpoints separated by commas (default: $DSP_SERVER)')
+  parser.add_argument('--port', default=DSP_PORT, help='DSP server port (default: $DSP_PORT or 2021)')
+  parser.add_argument('-u', '--username', default=os.environ.get('DSP_USERNAME'), help='default: $DSP_USERNAME')
+  parser.add_argument('-p', '--password', default=os.environ.get('DSP_PASSWORD'), help='default: $DSP_PASSWORD')
+  parser.add_argument('--connect-timeout', type=float, default=dsm.CONNECT_TIMEOUT, help='seconds to wait for a connection')
+  parser.add_argument('--read-timeout', type=float, default=dsm.READ_TIMEOUT, help='seconds to wait for each response')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  send = commands.add_parser('send', help='send messages read from a file or stdin')
+  send.add_argument('file', nargs='?', default='-', help='JSON lines or CSV rows of recipient,message[,timestamp]')
+  send.add_argument('--format', choices=('auto', 'json', 'csv'), default='auto')
+  send.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='commands pipelined per round trip')
+
+  commands.add_parser('all', help='write every message to stdout as NDJSON')
+  commands.add_parser('new', help='write the new messages to stdout as NDJSON')
+  return parser
+
+
+"""
+Run the command line client and return the exit status: 0 on success, 1 if any message failed,
+2 if the client could not log in.
+"""
+def main(argv=None) -> int:
+  args = _parser().parse_args(argv)
+  if not args.username or not args.password:
+    print('ds_cli: a username and password are required', file=sys.stderr)
+    return 2
+
+  try:
+    messenger = dsm.DirectMessenger(username=args.username, password=args.password,
+                                    endpoints=ds_endpoints.parse_endpoints(args.server, args.port),
+                                    endpoint_cache=ds_endpoints.EndpointCache(),
+                                    connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
+  except Exception as e:
+    print(f'ds_cli: could not log in to {args.server}:{args.port}: {e}', file=sys.stderr)
+    return 2
+
+  try:
+    if args.command == 'send':
+      f = sys.stdin if args.file == '-' else open(args.file, newline='')
+      try:
+        sent, failed, seconds = send_rows(messenger, f, args.format, args.batch_size)
+      finally:
+        if f is not sys.stdin:
+          f.close()
+      rate = sent / seconds if seconds else 0.0
+      print(f'sent {sent}, failed {failed} in {seconds:.2f} s ({rate:.0f} msg/s)', file=sys.stderr)
+      return 1 if failed else 0
+
+    start = time.perf_counter()
+    messages = messenger.iter_all() if args.command == 'all' else messenger.iter_new()
+    count = dump(messages)
+    print(f'retrieved {count} messages in {time.perf_counter() - start:.2f} s', file=sys.stderr)
+    return 0
+  finally:
+    messenger.close()
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,162 @@
+import bisect
+import heapq
+from itertools import islice
+
+
+def _timestamp(message):
+  return message.timestamp
+
+
+"""
+The messages exchanged with one user, as two streams kept in timestamp order: the messages
+received from them and the messages sent to them. Messages are appended in O(1) when they arrive
+in order, which is the usual case, and inserted in place otherwise.
+The two streams are interleaved on demand with a k-way merge, so reading the latest page of a
+conversation costs O(page size) rather than O(history).
+"""
+class Conversation:
+  __slots__ = ('received', 'sent')
+
+  def __init__(self):
+    self.received = []
+    self.sent = []
+
+  def __len__(self):
+    return len(self.received) + len(self.sent)
+
+  """
+  The timestamp of the most recent message in either direction, or None for an empty conversation.
+  """
+  @property
+  def last_activity(self) -> float:
+    last = [stream[-1].timestamp for stream in (self.received, self.sent) if stream]
+    return max(last) if last else None
+
+  """
+  Iterate over the whole conversation, oldest first.
+  """
+  def __iter__(self):
+    return heapq.merge(self.received, self.sent, key=_timestamp)
+
+  """
+  Add a Message to the stream it belongs to.
+  """
+  def add(self, message):
+    stream = self.sent if message.recipient is not None else self.received
+    if not stream or stream[-1].timestamp <= message.timestamp:
+      stream.append(message)
+    else:
+      bisect.insort(stream, message, key=_timestamp)
+
+  """
+  Remove the message with the same timestamp and body as message from the stream it belongs to.
+  Returns true if one was found.
+  """
+  def remove(self, message) -> bool:
+    stream = self.sent if message.recipient is not None else self.received
+    i = bisect.bisect_left(stream, message.timestamp, key=_timestamp)
+    while i < len(stream) and stream[i].timestamp == message.timestamp:
+      if stream[i].body == message.body:
+        del stream[i]
+        return True
+      i += 1
+    return False
+
+  """
+  Return `count` messages, oldest first, after skipping the `skip` most recent ones.
+  latest(50) is the last page of the conversation, latest(50, 50) the page before it.
+  """
+  def latest(self, count:int, skip:int=0) -> list:
+    newest_first = heapq.merge(reversed(self.received), reversed(self.sent), key=_timestamp, reverse=True)
+    page = list(islice(newest_first, skip, skip + count))
+    page.reverse()
+    return page
+
+
+"""
+A conversation index that groups messages by the user they were exchanged with.
+Received messages are filed under their sender and sent messages under their recipient.
+It is built in a single pass over the messages and updated in place as new messages arrive,
+so the whole history never has to be grouped again.
+Messages are kept by reference, and users are listed in the order they first appeared.
+"""
+class ConversationIndex:
+  def __init__(self, messages=()):
+    self._conversations = {}
+    self.extend(messages)
+
+  def __len__(self):
+    return len(self._conversations)
+
+  def __contains__(self, user):
+    return user in self._conversations
+
+  """
+  Add one Message to the conversation with peer, which defaults to the other user of the message.
+  Returns true if this started a new conversation.
+  """
+  def add(self, message, peer:str=None) -> bool:
+    if peer is None:
+      peer = message.peer
+    conversation = self._conversations.get(peer)
+    started = conversation is None
+    if started:
+      conversation = self._conversations[peer] = Conversation()
+    conversation.add(message)
+    return started
+
+  """
+  Add many Messages in one pass. Returns a dict of the users whose conversations changed, in order
+  of first change, to the number of messages added to each.
+  """
+  def extend(self, messages) -> dict:
+    touched = {}
+    conversations = self._conversations
+    for message in messages:
+      peer = message.peer
+      conversation = conversations.get(peer)
+      if conversation is None:
+        conversations[peer] = conversation = Conversation()
+      conversation.add(message)
+      touched[peer] = touched.get(peer, 0) + 1
+    return touched
+
+  """
+  Remove Messages from their conversations; an emptied conversation is kept. Returns a dict of
+  the users whose conversations changed to the number of messages removed from each.
+  """
+  def remove(self, messages) -> dict:
+    touched = {}
+    for message in messages:
+      conversation = self._conversations.get(message.peer)
+      if conversation is not None and conversation.remove(message):
+        touched[message.peer] = touched.get(message.peer, 0) + 1
+    return touched
+
+  """
+  Start an empty conversation with a user. Does nothing if the conversation already exists.
+  """
+  def add_user(self, user:str) -> bool:
+    if user in self._conversations:
+      return False
+    self._conversations[user] = Conversation()
+    return True
+
+  """
+  Return the users in the order they first appeared.
+  """
+  def users(self) -> list:
+    return list(self._conversations)
+
+  """
+  Return the Conversation with one user.
+  """
+  def messages(self, user:str) -> Conversation:
+    conversation = self._conversations.get(user)
+    return conversation if conversation is not None else Conversation()
+
+  """
+  Return the conversations as a dict of user to Conversation.
+  """
+  def as_dict(self) -> dict:
+    return self._conversations
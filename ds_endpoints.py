@@ -0,0 +1,159 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.ds_messenger', 'endpoints.json')
+
+"""
+How long each candidate is given on its own before the next one is started, in seconds.
+This is the connection attempt delay recommended for Happy Eyeballs (RFC 8305).
+"""
+STAGGER = 0.25
+
+
+"""
+Parse a comma separated list of host[:port] endpoints into (host, port) pairs.
+Hosts without a port get default_port. An IPv6 address is written in brackets when it has a port,
+as in [::1]:2021, and may be written bare without one.
+"""
+def parse_endpoints(text:str, default_port:str='2021') -> list:
+  endpoints = []
+  for item in text.split(','):
+    item = item.strip()
+    if not item:
+      continue
+    if item.startswith('['):
+      host, _, rest = item[1:].partition(']')
+      port = rest[1:] if rest.startswith(':') and rest[1:].isdigit() else default_port
+    elif item.count(':') > 1:
+      host, port = item, default_port
+    else:
+      host, sep, port = item.rpartition(':')
+      if not sep or not port.isdigit():
+        host, port = item, default_port
+    endpoints.append((host, str(port)))
+  return endpoints
+
+
+"""
+Health check one endpoint: open and close a TCP connection within timeout seconds.
+Returns the connect time in seconds, or raises the OSError of the failed attempt.
+"""
+def probe(host:str, port:str, timeout:float) -> float:
+  start = time.perf_counter()
+  client = socket.create_connection((host, int(port)), timeout=timeout)
+  elapsed = time.perf_counter() - start
+  client.close()
+  return elapsed
+
+
+"""
+Connect to the first endpoint that answers, Happy Eyeballs style: candidates are tried in order,
+each started `stagger` seconds after the one before or as soon as it fails, and they all race in
+parallel from then on. The first TCP connection to complete wins and the others are closed.
+Returns (socket, (host, port), connect seconds). The socket is still blocking with the connect timeout
+set. If every candidate fails within timeout, the OSError of the last failure is raised.
+report, if given, is called with (endpoint, connect seconds or None) for each attempt that finished.
+"""
+def race(endpoints:list, timeout:float, stagger:float=STAGGER, report=None) -> tuple:
+  if not endpoints:
+    raise ValueError('No endpoints to connect to.')
+  results = queue.Queue()
+  done = threading.Event()
+  start = time.perf_counter()
+
+  def attempt(endpoint):
+    begin = time.perf_counter()
+    try:
+      client = socket.create_connection((endpoint[0], int(endpoint[1])), timeout=timeout)
+    except OSError as e:
+      results.put((endpoint, None, e))
+      return
+    if done.is_set():
+      client.close()
+    else:
+      results.put((endpoint, client, time.perf_counter() - begin))
+
+  pending = list(endpoints)
+  running = 0
+  error = None
+  deadline = start + timeout + stagger * (len(endpoints) - 1)
+  try:
+    while pending or running:
+      if pending:
+        threading.Thread(target=attempt, args=(pending.pop(0),), daemon=True).start()
+        running += 1
+      wait = stagger if pending else deadline - time.perf_counter()
+      try:
+        endpoint, client, outcome = results.get(timeout=max(0.0, wait))
+      except queue.Empty:
+        if pending:
+          continue
+        break
+      running -= 1
+      if report is not None:
+        report(endpoint, outcome if client is not None else None)
+      if client is not None:
+        done.set()
+        return client, endpoint, outcome
+      error = outcome
+  finally:
+    done.set()
+    # A connection that completed after the winner was chosen is closed here.
+    while True:
+      try:
+        _, client, _ = results.get_nowait()
+      except queue.Empty:
+        break
+      if client is not None:
+        client.close()
+  raise error if error is not None else socket.timeout('Timed out connecting to every endpoint.')
+
+
+"""
+Remembers how fast each endpoint connected, in a small JSON file, so that later sessions try the
+fastest healthy endpoint first. Endpoints that failed are tried last until they answer again.
+"""
+class EndpointCache:
+  def __init__(self, path:str=DEFAULT_PATH):
+    self.path = path
+    try:
+      with open(path) as f:
+        self._latency = json.load(f)
+    except (OSError, ValueError):
+      self._latency = {}
+
+  @staticmethod
+  def _key(endpoint) -> str:
+    return f'{endpoint[0]}:{endpoint[1]}'
+
+  """
+  Return the endpoints ordered by their last known connect time: the fastest first, then the
+  ones never tried in their given order, then the ones that failed.
+  """
+  def order(self, endpoints:list) -> list:
+    def rank(item):
+      i, endpoint = item
+      key = self._key(endpoint)
+      if key not in self._latency:
+        return (1, 0.0, i)
+      latency = self._latency[key]
+      return (2, 0.0, i) if latency is None else (0, latency, i)
+    return [endpoint for _, endpoint in sorted(enumerate(endpoints), key=rank)]
+
+  """
+  Record the connect time of an endpoint, or None if it failed, and save the file.
+  """
+  def record(self, endpoint, latency:float):
+    self._latency[self._key(endpoint)] = latency
+    try:
+      os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+      tmp = self.path + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump(self._latency, f)
+      os.replace(tmp, self.path)
+    except OSError:
+      pass
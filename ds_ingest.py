@@ -0,0 +1,125 @@
+import hashlib
+import math
+from collections import OrderedDict
+
+"""
+Return the stable identity of a Message: a 16 byte digest of its sender, timestamp, recipient and
+body. The server gives messages no id, so two copies of a message, whether they came through
+retrieve_new, retrieve_all or a poll repeated after a reconnect, have the same key.
+"""
+def message_key(msg) -> bytes:
+  data = f'{msg.sender}\0{msg.timestamp!r}\0{msg.recipient or ""}\0{msg.body}'.encode()
+  return hashlib.blake2b(data, digest_size=16).digest()
+
+
+"""
+An exact set of the most recently seen keys, holding at most capacity of them.
+When full, the key seen least recently is forgotten; a duplicate of a key that old is let through again.
+"""
+class RecentSet:
+  def __init__(self, capacity:int):
+    self.capacity = capacity
+    self._keys = OrderedDict()
+
+  def __len__(self):
+    return len(self._keys)
+
+  """
+  Record key. Returns true if it was not already in the set.
+  """
+  def add(self, key:bytes) -> bool:
+    keys = self._keys
+    if key in keys:
+      keys.move_to_end(key)
+      return False
+    keys[key] = None
+    if len(keys) > self.capacity:
+      keys.popitem(last=False)
+    return True
+
+
+"""
+A Bloom filter sized for capacity keys at the given false positive rate, using a fixed number of bits
+whatever the traffic. Two generations are kept: once the current one has taken capacity keys it becomes
+the previous one and a fresh one is started, so old keys age out instead of saturating the filter.
+A false positive makes a new message look seen, so use it only where dropping about error_rate of the
+new messages is acceptable; RecentSet is exact.
+"""
+class BloomFilter:
+  def __init__(self, capacity:int, error_rate:float=0.001):
+    self.capacity = capacity
+    self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+    self._current = bytearray((self.bits + 7) // 8)
+    self._previous = bytearray(len(self._current))
+    self._count = 0
+
+  def __len__(self):
+    return self._count
+
+  def _positions(self, key:bytes):
+    # Double hashing: the k positions are h1 + i*h2, from the two halves of the key digest.
+    h1 = int.from_bytes(key[:8], 'little')
+    h2 = int.from_bytes(key[8:16], 'little') | 1
+    return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+  @staticmethod
+  def _contains(bits:bytearray, positions) -> bool:
+    return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+  """
+  Record key, which must be a digest of at least 16 bytes such as message_key returns.
+  Returns true if it was (probably) not seen before.
+  """
+  def add(self, key:bytes) -> bool:
+    positions = self._positions(key)
+    if self._contains(self._current, positions):
+      return False
+    seen = self._contains(self._previous, positions)
+    if self._count >= self.capacity:
+      self._previous = self._current
+      self._current = bytearray(len(self._previous))
+      self._count = 0
+    bits = self._current
+    for p in positions:
+      bits[p >> 3] |= 1 << (p & 7)
+    self._count += 1
+    return not seen
+
+
+"""
+The ingest stage between the messenger and whatever consumes its messages. Each Message is keyed
+with message_key and checked against a bounded structure of keys already seen, and only the messages
+not seen before are passed on, so polling the same history again costs memory in proportion to the
+new messages rather than to the whole history.
+kind is 'lru' for an exact RecentSet of capacity keys or 'bloom' for a BloomFilter of the same capacity.
+"""
+class Deduplicator:
+  def __init__(self, capacity:int=100000, kind:str='lru', error_rate:float=0.001):
+    if kind == 'lru':
+      self._seen = RecentSet(capacity)
+    elif kind == 'bloom':
+      self._seen = BloomFilter(capacity, error_rate)
+    else:
+      raise ValueError(f'Unknown deduplicator kind {kind!r}')
+    self.kind = kind
+    self.accepted = 0
+    self.duplicates = 0
+
+  """
+  Return true if msg has not been seen before, and remember it.
+  """
+  def add(self, msg) -> bool:
+    if self._seen.add(message_key(msg)):
+      self.accepted += 1
+      return True
+    self.duplicates += 1
+    return False
+
+  """
+  Yield only the messages of an iterable that have not been seen before.
+  """
+  def filter(self, messages):
+    for msg in messages:
+      if self.add(msg):
+        yield msg
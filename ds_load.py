@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import ds_bench
+import ds_messenger as dsm
+
+"""
+A load generator for DSP server deployments. Many virtual users, each an AsyncDirectMessenger on its
+own connection, run a scripted scenario on one event loop, joining at an even rate over the ramp-up.
+Every join, send and retrieve is timed, and throughput, errors and latency percentiles are reported
+per interval while the run goes on and for the whole run at the end.
+
+Scenarios:
+  login_storm  every user joins, fetches its new messages and disconnects, over and over
+  chatty_pairs users talk in pairs, each sending to its partner and polling for the reply
+  broadcast    user 0 sends every message to all other users, who poll for them
+"""
+
+
+"""
+Summarize a list of latencies in seconds with exact percentiles, in milliseconds.
+"""
+def latency_summary(values:list) -> dict:
+  return {
+    'count': len(values),
+    'mean_ms': sum(values) / len(values) * 1000,
+    'min_ms': min(values) * 1000,
+    'max_ms': max(values) * 1000,
+    'p50_ms': ds_bench.percentile(values, 50) * 1000,
+    'p90_ms': ds_bench.percentile(values, 90) * 1000,
+    'p99_ms': ds_bench.percentile(values, 99) * 1000,
+  }
+
+
+"""
+Collects the latency of every operation, and its errors, in one window per interval seconds.
+Every latency is kept, so the percentiles of each window are exact rather than estimated from buckets.
+"""
+class Recorder:
+  def __init__(self, interval:float=1.0):
+    self.interval = interval
+    self.start = time.monotonic()
+    self.active = 0
+    self.windows = {}
+    self.totals = self._window()
+
+  @staticmethod
+  def _window() -> dict:
+    return {'ops': {}, 'errors': {}, 'received': 0, 'active': 0}
+
+  def _current(self) -> dict:
+    index = int((time.monotonic() - self.start) // self.interval)
+    window = self.windows.get(index)
+    if window is None:
+      window = self.windows[index] = self._window()
+    window['active'] = max(window['active'], self.active)
+    return window
+
+  """
+  Record one successful operation that took seconds.
+  """
+  def observe(self, op:str, seconds:float):
+    for window in (self._current(), self.totals):
+      samples = window['ops'].get(op)
+      if samples is None:
+        samples = window['ops'][op] = []
+      samples.append(seconds)
+
+  """
+  Record one failed operation, counted under the exception's class name.
+  """
+  def error(self, op:str, error:Exception):
+    key = f'{op}.{type(error).__name__}'
+    for window in (self._current(), self.totals):
+      window['errors'][key] = window['errors'].get(key, 0) + 1
+
+  """
+  Record n messages delivered to a user.
+  """
+  def received(self, n:int):
+    self._current()['received'] += n
+    self.totals['received'] += n
+
+  """
+  Summarize a window: operations and errors per second, and latency percentiles per operation.
+  """
+  def summarize(self, window:dict, seconds:float) -> dict:
+    ops = sum(len(samples) for samples in window['ops'].values())
+    errors = sum(window['errors'].values())
+    return {
+      'active_users': window['active'],
+      'ops_per_s': ops / seconds,
+      'errors_per_s': errors / seconds,
+      'error_rate': errors / (ops + errors) if ops + errors else 0.0,
+      'received_per_s': window['received'] / seconds,
+      'errors': dict(window['errors']),
+      'latency': {op: latency_summary(samples) for op, samples in sorted(window['ops'].items())},
+    }
+
+  """
+  Return the summaries of every finished window, oldest first, each with its start time in seconds.
+  """
+  def timeline(self) -> list:
+    return [dict(t=index * self.interval, **self.summarize(self.windows[index], self.interval))
+            for index in sorted(self.windows)]
+
+
+"""
+Run one operation of a virtual user and record its latency, or its error before raising it again.
+"""
+async def timed(recorder:Recorder, op:str, awaitable):
+  start = time.perf_counter()
+  try:
+    result = await awaitable
+  except Exception as e:
+    recorder.error(op, e)
+    raise
+  recorder.observe(op, time.perf_counter() - start)
+  return result
+
+
+"""
+Everything the virtual users of one run share.
+"""
+class LoadContext:
+  def __init__(self, host:str, port:str, users:int, recorder:Recorder, think:float=1.0, prefix:str='load',
+               connect_timeout:float=dsm.CONNECT_TIMEOUT, read_timeout:float=dsm.READ_TIMEOUT):
+    self.host = host
+    self.port = port
+    self.users = users
+    self.recorder = recorder
+    self.think = think
+    self.prefix = prefix
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.stop = asyncio.Event()
+
+  def username(self, n:int) -> str:
+    return f'{self.prefix}{n}'
+
+  """
+  Log user n in, timing the connect and join.
+  """
+  async def open(self, n:int):
+    messenger = dsm.AsyncDirectMessenger(self.host, self.username(n), 'password', self.port,
+                                         self.connect_timeout, self.read_timeout)
+    await timed(self.recorder, 'join', messenger.connect())
+    return messenger
+
+  """
+  Sleep for about the think time, or less if the run is stopping. Returns true if the user should go on.
+  The time is randomized by +/-50% so the users do not fall into lockstep.
+  """
+  async def pause(self) -> bool:
+    try:
+      await asyncio.wait_for(self.stop.wait(), self.think * random.uniform(0.5, 1.5))
+    except asyncio.TimeoutError:
+      return True
+    return False
+
+
+async def login_storm(ctx:LoadContext, n:int):
+  while not ctx.stop.is_set():
+    messenger = await ctx.open(n)
+    try:
+      messages = await timed(ctx.recorder, 'new', messenger.retrieve_new())
+      ctx.recorder.received(len(messages))
+    finally:
+      await messenger.close()
+    if not await ctx.pause():
+      return
+
+
+async def chatty_pairs(ctx:LoadContext, n:int):
+  partner = n ^ 1 if n ^ 1 < ctx.users else n
+  messenger = await ctx.open(n)
+  try:
+    i = 0
+    while True:
+      await timed(ctx.recorder, 'send', messenger.send(f'message {i} from {ctx.username(n)}', ctx.username(partner)))
+      messages = await timed(ctx.recorder, 'new', messenger.retrieve_new())
+      ctx.recorder.received(len(messages))
+      i += 1
+      if not await ctx.pause():
+        return
+  finally:
+    await messenger.close()
+
+
+async def broadcast(ctx:LoadContext, n:int):
+  messenger = await ctx.open(n)
+  try:
+    i = 0
+    while True:
+      if n == 0:
+        recipients = [ctx.username(m) for m in range(1, ctx.users)]
+        await timed(ctx.recorder, 'broadcast',
+                    messenger.send_many([(f'broadcast {i}', recipient) for recipient in recipients]))
+        i += 1
+      else:
+        messages = await timed(ctx.recorder, 'new', messenger.retrieve_new())
+        ctx.recorder.received(len(messages))
+      if not await ctx.pause():
+        return
+  finally:
+    await messenger.close()
+
+
+SCENARIOS = {
+  'login_storm': login_storm,
+  'chatty_pairs': chatty_pairs,
+  'broadcast': broadcast,
+}
+
+
+"""
+Run one virtual user until the run stops. A user whose session fails is started again after a
+pause, so errors are counted for as long as they keep happening rather than ending the user.
+"""
+async def virtual_user(ctx:LoadContext, scenario, n:int):
+  ctx.recorder.active += 1
+  try:
+    while not ctx.stop.is_set():
+      try:
+        await scenario(ctx, n)
+      except (OSError, ValueError, KeyError, dsm.ProtocolError, dsm.ServerNodeNameError,
+              dsm.ServerTimeoutError, dsm.NoInternetError, dsm.InvalidLoginError):
+        # Already recorded by timed().
+        if not await ctx.pause():
+          return
+  finally:
+    ctx.recorder.active -= 1
+
+
+"""
+Print one line for a finished window.
+"""
+def print_window(window:dict, out=sys.stderr):
+  latency = ' '.join(f"{op} p50={h['p50_ms']:.1f} p99={h['p99_ms']:.1f}ms" for op, h in window['latency'].items())
+  print(f"t={window['t']:>5.0f}s users={window['active_users']:>5} ops/s={window['ops_per_s']:>8.0f} "
+        f"err/s={window['errors_per_s']:>6.1f} recv/s={window['received_per_s']:>8.0f} {latency}", file=out)
+
+
+"""
+Run a scenario with `users` virtual users against host:port: users are started evenly over ramp
+seconds and the run stops duration seconds after the first one. Returns the timeline of interval
+summaries and the summary of the whole run.
+"""
+async def run(host:str, port:str, scenario:str='chatty_pairs', users:int=100, ramp:float=10.0,
+              duration:float=30.0, think:float=1.0, interval:float=1.0, prefix:str=None, live:bool=True,
+              connect_timeout:float=dsm.CONNECT_TIMEOUT, read_timeout:float=dsm.READ_TIMEOUT) -> dict:
+  recorder = Recorder(interval)
+  if prefix is None:
+    prefix = f'load{os.getpid()}_{int(time.time())}_'
+  ctx = LoadContext(host, port, users, recorder, think, prefix, connect_timeout, read_timeout)
+  func = SCENARIOS[scenario]
+
+  async def start_user(n):
+    await asyncio.sleep(ramp * n / users)
+    if not ctx.stop.is_set():
+      await virtual_user(ctx, func, n)
+
+  async def report():
+    shown = 0
+    while True:
+      await asyncio.sleep(interval)
+      finished = int((time.monotonic() - recorder.start) // interval)
+      for index in range(shown, finished):
+        if index in recorder.windows:
+          print_window(dict(t=index * interval, **recorder.summarize(recorder.windows[index], interval)))
+      shown = finished
+
+  tasks = [asyncio.create_task(start_user(n)) for n in range(users)]
+  reporter = asyncio.create_task(report()) if live else None
+  await asyncio.sleep(duration)
+  ctx.stop.set()
+  # Users finish the operation in progress; any still stuck on the network after a grace period are cancelled.
+  done, pending = await asyncio.wait(tasks, timeout=max(5.0, think * 2))
+  for task in pending:
+    task.cancel()
+  await asyncio.gather(*pending, return_exceptions=True)
+  if reporter is not None:
+    reporter.cancel()
+
+  elapsed = time.monotonic() - recorder.start
+  return {
+    'scenario': scenario,
+    'host': host,
+    'port': str(port),
+    'users': users,
+    'ramp_s': ramp,
+    'duration_s': duration,
+    'think_s': think,
+    'total': recorder.summarize(recorder.totals, elapsed),
+    'timeline': recorder.timeline(),
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Simulate many concurrent DSP clients against a server.')
+  parser.add_argument('--host', default=os.environ.get('DSP_SERVER', '127.0.0.1'))
+  parser.add_argument('--port', default=os.environ.get('DSP_PORT', '2021'))
+  parser.add_argument('--local', action='store_true', help='start a local ds_server.py on a free port and load it')
+  parser.add_argument('--latency', type=float, default=0.0, help='artificial latency of the --local server in seconds')
+  parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='chatty_pairs')
+  parser.add_argument('--users', type=int, default=100, help='number of virtual users')
+  parser.add_argument('--ramp', type=float, default=10.0, help='seconds over which the users are started')
+  parser.add_argument('--duration', type=float, default=30.0, help='seconds the run lasts')
+  parser.add_argument('--think', type=float, default=1.0, help='mean pause between a user\'s operations in seconds')
+  parser.add_argument('--interval', type=float, default=1.0, help='length of the reported windows in seconds')
+  parser.add_argument('--connect-timeout', type=float, default=dsm.CONNECT_TIMEOUT, help='seconds to wait for a connection')
+  parser.add_argument('--read-timeout', type=float, default=dsm.READ_TIMEOUT, help='seconds to wait for each response')
+  parser.add_argument('--output', help='file the JSON results are written to')
+  args = parser.parse_args()
+
+  proc = None
+  if args.local:
+    proc, args.port = ds_bench.start_server(0, 1, args.latency)
+    args.host = '127.0.0.1'
+  try:
+    results = asyncio.run(run(args.host, args.port, args.scenario, args.users, args.ramp, args.duration,
+                              args.think, args.interval, connect_timeout=args.connect_timeout,
+                              read_timeout=args.read_timeout))
+  finally:
+    if proc is not None:
+      proc.terminate()
+      proc.wait()
+
+  print(json.dumps(results['total'], indent=2))
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
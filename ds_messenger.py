@@ -1,6 +1,15 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+import asyncio
+import errno
+import select
 import socket
-import json, time
+import json, re, sys, time
+import ds_endpoints
+import ds_metrics
+
+# Seconds allowed to open a connection, and to wait for each read from the server, before giving up.
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
 
 """
 A customized exception. Raised when username already taken or invalid password entered in the login page.
@@ -26,8 +35,108 @@ A customized exception. Raised when there is no internet connection (after OSErr
 class NoInternetError(Exception):
   pass
 
+"""
+A customized exception. Raised when the server does not answer within the connect or read deadline.
+"""
+class ServerTimeoutError(Exception):
+  pass
+
+
+"""
+Map an OSError raised while connecting to the exception shown to the user. errno values differ
+between platforms (ENETUNREACH is 51 on macOS and 101 on Linux), so they are compared by name.
+"""
+def _connection_error(e:OSError) -> Exception:
+  if isinstance(e, (socket.timeout, TimeoutError)):
+    return ServerTimeoutError('The server did not answer in time.')
+  if isinstance(e, (socket.gaierror, ConnectionRefusedError)) or e.errno == 8:
+    return ServerNodeNameError('Wrong SERVER or wrong PORT.')
+  if e.errno in (errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN):
+    return NoInternetError('No internet connection.')
+  return ProtocolError('Invalid socket connection')
+
+
+"""
+A compact record of one direct message, created once from the server's dict when the message
+is received and then shared by reference by the store, the conversation index and the GUI.
+The sender name is interned, so one string is shared by all of a sender's messages, and the
+timestamp is kept as a float. Messages the user sent are recorded locally with their recipient;
+received messages have no recipient.
+"""
+class Message:
+  __slots__ = ('sender', 'timestamp', 'body', 'recipient')
+
+  def __init__(self, sender:str, timestamp:float, body:str, recipient:str=None):
+    self.sender = sys.intern(sender)
+    self.timestamp = float(timestamp)
+    self.body = body
+    self.recipient = sys.intern(recipient) if recipient is not None else None
+
+  """
+  True if the user sent this message.
+  """
+  @property
+  def outgoing(self) -> bool:
+    return self.recipient is not None
+
+  """
+  The other user of the conversation the message belongs to.
+  """
+  @property
+  def peer(self) -> str:
+    return self.recipient if self.recipient is not None else self.sender
+
+  """
+  Build a Message from a message dict in the server format.
+  """
+  @classmethod
+  def from_dict(cls, msg:dict):
+    return cls(msg['from'], msg['timestamp'], msg['message'])
+
+  """
+  Return the message as a dict in the server format.
+  """
+  def to_dict(self) -> dict:
+    return {'message': self.body, 'from': self.sender, 'timestamp': self.timestamp}
+
+  def __eq__(self, other):
+    if not isinstance(other, Message):
+      return NotImplemented
+    return ((self.sender, self.timestamp, self.body, self.recipient) ==
+            (other.sender, other.timestamp, other.body, other.recipient))
+
+  def __hash__(self):
+    return hash((self.sender, self.timestamp, self.body, self.recipient))
+
+  def __repr__(self):
+    return (f'Message(sender={self.sender!r}, timestamp={self.timestamp!r}, body={self.body!r}, '
+            f'recipient={self.recipient!r})')
+
 
 DSConnection = namedtuple('DSConnection', ['socket', 'send', 'recv'])
+
+_MESSAGES_START = re.compile(r'"messages"\s*:\s*\[')
+_SKIP = re.compile(r'[\s,]*')
+
+
+"""
+Return the current time, or a microsecond after last if the clock has not moved past it, so the
+messages one messenger stamps are strictly increasing even where the clock is coarse.
+"""
+def _next_timestamp(last:float) -> float:
+  return max(time.time(), last + 1e-6)
+
+
+"""
+Name the kind of a command for the metrics: join, send, new or all.
+"""
+def _command_type(cmd:dict) -> str:
+  if 'join' in cmd:
+    return 'join'
+  request = cmd.get('directmessage')
+  return 'send' if isinstance(request, dict) else str(request)
+
+
 """
 A class working as a protocol. 
 This class supports connecting to the server, joining into the dsuserver with a valid username and password. 
@@ -39,33 +148,92 @@ class DirectMessage:
     self.message = None
     self.timestamp = None
     self._newuser = None
+    self.last_read_size = 0
+    self._in_flight = deque()
+    # The open DSConnection, or None. Kept apart from the connection() method so that a closed
+    # DirectMessage can connect again.
+    self.conn = None
 
   """
   Connect to the dsuserver and port.
+  Gives up after connect_timeout seconds, and every later read fails after read_timeout seconds
+  without data, so a dead server is noticed in seconds rather than after the kernel's timeouts.
   """
-  def connection(self, server:str, port:str):
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    PORT = int(port)
-    
+  def connection(self, server:str, port:str, connect_timeout:float=CONNECT_TIMEOUT, read_timeout:float=READ_TIMEOUT):
     try:
-      client.connect((server, PORT))
-      f_send = client.makefile('w')
-      f_recv = client.makefile('r')
+      client = socket.create_connection((server, int(port)), timeout=connect_timeout)
+    except OSError as e:
+      raise _connection_error(e)
+    except (TypeError, ValueError):
+      raise ProtocolError('Invalid socket connection')
+    self._attach(client, read_timeout)
 
+  """
+  Connect to whichever of several (server, port) endpoints answers first, racing them in parallel
+  as described in ds_endpoints.race. Endpoints are tried in the order given, so put the one
+  expected to be fastest first. Returns the endpoint that was connected to.
+  """
+  def connect_fastest(self, endpoints:list, connect_timeout:float=CONNECT_TIMEOUT,
+                      read_timeout:float=READ_TIMEOUT, report=None) -> tuple:
+    try:
+      client, endpoint, _ = ds_endpoints.race(endpoints, connect_timeout, report=report)
     except OSError as e:
-      code = e.errno
-      if code == 8:
-        raise ServerNodeNameError('Wrong SERVER or wrong PORT.')
-      elif code == 51:
-        raise NoInternetError('No internet connection.') 
-    except:
-        raise ProtocolError('Invalid socket connection')
-    else:
-      self.connection = DSConnection(
-          socket = client,
-          send = f_send,
-          recv = f_recv
-      )
+      raise _connection_error(e)
+    except (TypeError, ValueError):
+      raise ProtocolError('Invalid socket connection')
+    self._attach(client, read_timeout)
+    return endpoint
+
+  def _attach(self, client, read_timeout:float):
+    client.settimeout(read_timeout)
+    # UTF-8 both ways, and no newline translation: lines end in '\r\n' on the wire, and the sizes
+    # reported to the metrics are the encoded length of exactly what was read or written.
+    self.conn = DSConnection(
+        socket = client,
+        send = client.makefile('w', encoding='utf-8', newline='\n'),
+        recv = client.makefile('r', encoding='utf-8', newline='\n')
+    )
+
+  """
+  Return true if a connection has been opened and not closed since.
+  """
+  def is_connected(self) -> bool:
+    return self.conn is not None
+
+  """
+  Close the socket, if one is open.
+  """
+  def close(self):
+    if self.is_connected():
+      connection = self.conn
+      self.conn = None
+      for f in (connection.send, connection.recv, connection.socket):
+        try:
+          f.close()
+        except OSError:
+          pass
+
+  """
+  Return true if the connection is open and the server has not closed its end. Checked before a
+  command is written, so that a session dropped while idle is replaced before anything is sent on it.
+  """
+  def is_alive(self) -> bool:
+    if not self.is_connected():
+      return False
+    sock = self.conn.socket
+    try:
+      readable, _, _ = select.select([sock], [], [], 0)
+      # Nothing is due from the server between responses, so a readable socket is at its end or reset.
+      return not readable or bool(sock.recv(1, socket.MSG_PEEK))
+    except BlockingIOError:
+      return True
+    except (OSError, ValueError):
+      return False
+
+  def _check_connected(self):
+    if not self.is_connected():
+      ds_metrics.metrics.incr('connection.errors')
+      raise ConnectionResetError('Not connected to the server.')
   
   """
   Join into the server using given username and password. 
@@ -77,24 +245,20 @@ class DirectMessage:
     self.user_token = user_token
 
     cmd = {"join": {"username": self.username, "password": self.password, "token": self.user_token}}
+    start = time.perf_counter()
     self._write_command(cmd)
     try:
       response = self._read_command()
+      ds_metrics.metrics.observe('join', time.perf_counter() - start)
 
     except ConnectionResetError:
       raise ServerNodeNameError('Wrong SERVER or wrong PORT.')
 
     except OSError as e:
-      code = e.errno
-      if code == 8:
-        raise ServerNodeNameError('Wrong SERVER or wrong PORT.')
-      elif code == 51:
-        raise NoInternetError('No internet connection.')
-      else:
+      error = _connection_error(e)
+      if isinstance(error, ProtocolError):
         raise Exception('Connection Error')
-
-    except ConnectionRefusedError:
-      raise Exception('Connection Refused.')
+      raise error
 
     except TypeError:
       raise Exception("Failed to connect! Check your server location.")
@@ -128,74 +292,696 @@ class DirectMessage:
 
   """
   Write command to the server.
+  Each command is terminated by a line break so that several commands can be written back-to-back.
   """
   def _write_command(self, cmd):
+    self._write_commands([cmd])
+
+  """
+  Write several commands to the server with a single flush, without waiting for any response.
+  """
+  def _write_commands(self, cmds:list):
+    self._check_connected()
+    written = 0
     try:
-      json.dump(cmd, self.connection.send)
-      self.connection.send.flush()
+      for cmd in cmds:
+        line = json.dumps(cmd) + '\r\n'
+        self.conn.send.write(line)
+        written += len(line.encode())
+      self.conn.send.flush()
+    except OSError:
+      ds_metrics.metrics.incr('connection.errors')
+      raise
     except Exception as e:
       raise Exception(e)
-    
+    now = time.perf_counter()
+    self._in_flight.extend((_command_type(cmd), now) for cmd in cmds)
+    ds_metrics.metrics.incr('bytes.out', written)
+
   """
   Read the response message from the server. 
   """
   def _read_command(self):
-    cmd = json.loads(self.connection.recv.readline()[:-1])
+    self._check_connected()
+    try:
+      line = self.conn.recv.readline()
+      if not line:
+        raise ConnectionResetError('Connection closed by the server.')
+    except OSError:
+      ds_metrics.metrics.incr('connection.errors')
+      raise
+    # Sizes are in bytes on the wire, not characters of the decoded line.
+    self.last_read_size = len(line.encode())
+    cmd = json.loads(line[:-1])
+    self._record_response(self.last_read_size, cmd.get('response', {}).get('type') == 'ok')
     return cmd
 
+  """
+  Report the latency and size of the response to the oldest command still waiting for one.
+  """
+  def _record_response(self, size:int, ok:bool):
+    metrics = ds_metrics.metrics
+    metrics.incr('bytes.in', size)
+    if self._in_flight:
+      kind, start = self._in_flight.popleft()
+      metrics.observe('command.' + kind, time.perf_counter() - start)
+      if not ok:
+        metrics.incr('command.' + kind + '.errors')
+
+  """
+  Read a response carrying a list of messages and yield the messages one at a time while the
+  response is still arriving, instead of holding the whole line and its parsed copy in memory.
+  The response is read in chunks of at most chunk_size characters and never past its end; its size is
+  counted in bytes.
+  If the generator is closed early, the rest of the response is drained so the connection stays usable.
+  """
+  def _read_messages(self, chunk_size:int=65536):
+    self._check_connected()
+    decoder = json.JSONDecoder()
+    recv = self.conn.recv
+    buf = ''
+    pos = 0
+    size = 0
+    complete = False
+    ok = True
+
+    def read_more():
+      nonlocal buf, pos, size, complete
+      chunk = recv.readline(chunk_size)
+      if not chunk:
+        ds_metrics.metrics.incr('connection.errors')
+        raise ConnectionResetError('Connection closed by the server.')
+      size += len(chunk.encode())
+      complete = chunk.endswith('\n')
+      buf = buf[pos:] + chunk
+      pos = 0
+
+    try:
+      start = None
+      while start is None:
+        read_more()
+        start = _MESSAGES_START.search(buf)
+        if start is None and complete:
+          response = json.loads(buf)
+          ok = False
+          raise ProtocolError(self.extract_response_msg(response))
+      pos = start.end()
+
+      while True:
+        pos = _SKIP.match(buf, pos).end()
+        if pos == len(buf):
+          read_more()
+          continue
+        if buf[pos] == ']':
+          break
+        try:
+          message, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+          if complete:
+            raise
+          read_more()
+          continue
+        pos = end
+        yield message
+
+      while not complete:
+        pos = len(buf)
+        read_more()
+    finally:
+      while not complete:
+        try:
+          pos = len(buf)
+          read_more()
+        except OSError:
+          break
+      self.last_read_size = size
+      self._record_response(size, ok and complete)
+
 
 """
 A class that works similar as ds_client module. 
 This class helps send message to a specific recipient, retrieve all messages and new messages received by the user.
 """
 class DirectMessenger:
-  def __init__(self, dsuserver=None, username=None, password=None):
+  def __init__(self, dsuserver=None, username=None, password=None, port='2021', endpoints=None,
+               endpoint_cache=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, ingest=None):
     self.token = None
     self.dsuserver = dsuserver
+    self.port = port
+    self.endpoints = endpoints
+    self.endpoint_cache = endpoint_cache
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
     self.username = username
     self.password = password
     self.msg_all = []
     self.msg_new = []
-
+    self.reconnects = 0
+    self.last_latency = None
+    self._last_timestamp = 0.0
+    self.store = None
+    self.account = None
+    # An optional ds_ingest.Deduplicator. When set, every retrieve and iter method passes on only
+    # the messages it has not seen before.
+    self.ingest = ingest
     self.server_connect = DirectMessage()
-    self.server_connect.connection(self.dsuserver, '2021')
-    
-    self.server_connect.join(self.username, self.password, self.token)
-    self.token = self.server_connect.user_token
+
+    self._connect()
     self._is_new = self.server_connect._newuser
 
+  """
+  Open a socket to the dsuserver and join with the stored username and password.
+  The socket is kept open and reused by every later request.
+  When a list of (server, port) endpoints was given, they are raced and the first to answer is
+  used; with an endpoint_cache, the fastest endpoint of earlier sessions is tried first.
+  """
+  def _connect(self):
+    if self.endpoints:
+      self._connect_fastest()
+      return
+    # The session is only replaced once the new one has joined, so a failed attempt leaves
+    # server_connect unconnected rather than half built, and the next request tries again.
+    session = DirectMessage()
+    session.connection(self.dsuserver, self.port, self.connect_timeout, self.read_timeout)
+    try:
+      session.join(self.username, self.password)
+    except Exception:
+      session.close()
+      raise
+    self.server_connect = session
+    self.token = session.user_token
+
+  """
+  Race the endpoints and join on the winner. The join is the health check: an endpoint that
+  accepts the connection but then fails to answer is marked failed and the others are raced again.
+  """
+  def _connect_fastest(self):
+    cache = self.endpoint_cache
+    candidates = cache.order(self.endpoints) if cache is not None else list(self.endpoints)
+    report = cache.record if cache is not None else None
+    while True:
+      session = DirectMessage()
+      endpoint = session.connect_fastest(candidates, self.connect_timeout, self.read_timeout, report)
+      try:
+        session.join(self.username, self.password)
+      except InvalidLoginError:
+        session.close()
+        raise
+      except Exception:
+        session.close()
+        if report is not None:
+          report(endpoint, None)
+        candidates.remove(endpoint)
+        if not candidates:
+          raise
+        continue
+      self.server_connect = session
+      self.token = session.user_token
+      self.dsuserver, self.port = endpoint
+      return
+
+  """
+  Drop the current socket and join again. Called only when the session is lost.
+  """
+  def reconnect(self):
+    ds_metrics.metrics.incr('reconnects')
+    self.close()
+    self._connect()
+    self.reconnects += 1
+
+  """
+  Attach the local message store that holds this user's messages under account, so they can be searched.
+  """
+  def attach_store(self, store, account:str):
+    self.store = store
+    self.account = account
+
+  """
+  Search the messages held in the attached local store. Returns the Messages containing every word
+  of query, best matches first.
+  """
+  def search(self, query:str, limit:int=20) -> list:
+    if self.store is None:
+      raise ValueError('No local store attached; call attach_store first.')
+    return self.store.search(self.account, query, limit)
+
+  """
+  Close the socket held by the session.
+  """
+  def close(self):
+    self.server_connect.close()
+
+  """
+  Write commands through the open session. A session the server has closed is replaced first,
+  and if the write itself fails the session is reconnected and the commands are written once more.
+  """
+  def _write(self, cmds:list):
+    if not self.server_connect.is_alive():
+      self.reconnect()
+    try:
+      for cmd in cmds:
+        cmd['token'] = self.token
+      self.server_connect._write_commands(cmds)
+    except (OSError, ValueError):
+      self.reconnect()
+      for cmd in cmds:
+        cmd['token'] = self.token
+      self.server_connect._write_commands(cmds)
+
+  """
+  Close the session after a read failed on commands that were already written, and return the error
+  to raise. The server may have acted on them, so they are not written again here.
+  """
+  def _read_failed(self, error:Exception) -> Exception:
+    self.close()
+    if isinstance(error, socket.timeout):
+      return ServerTimeoutError('The server did not answer in time.')
+    return error
+
+  """
+  Write a command through the open session and return the server response.
+  If the socket has dropped, reconnect and re-join once, then retry the command. A command is
+  never written twice once the server may have received it: if no answer comes within the read
+  deadline, ServerTimeoutError is raised, and a send whose connection closed before the answer
+  is not retried.
+  """
+  def _request(self, cmd:dict) -> dict:
+    self._write([cmd])
+    try:
+      return self.server_connect._read_command()
+    except (OSError, ValueError) as e:
+      error = self._read_failed(e)
+      if error is not e or _command_type(cmd) == 'send':
+        raise error
+    # Retrieving again is harmless, so a retrieve is retried on a fresh session.
+    self._write([cmd])
+    return self.server_connect._read_command()
+
+  """
+  Return a timestamp for a new message, later than any this messenger handed out before. The
+  timestamp is part of a message's identity in the store and in ds_ingest, so two messages with the
+  same body and recipient must not share one.
+  """
+  def _stamp(self) -> float:
+    self._last_timestamp = _next_timestamp(self._last_timestamp)
+    return self._last_timestamp
+
   """
   Sends direct messages to another user.
   Returns true if message successfully sent, false if send failed.
+  The round trip time of the send, in seconds, is kept in last_latency.
   """
   def send(self, message:str, recipient:str) -> bool:
     self.server_connect.recipient = recipient
     self.server_connect.message = message
 
-    timestamp = time.time()
+    timestamp = self._stamp()
     cmd = {"token": self.token, "directmessage": {"entry": message, "recipient": recipient, "timestamp": timestamp}}
-    self.server_connect._write_command(cmd)
-    res = self.server_connect._read_command()
+    start = time.perf_counter()
+    res = self._request(cmd)
+    self.last_latency = time.perf_counter() - start
+    return self._is_ok(res)
+
+  """
+  Sends many direct messages in pipelined batches. The commands of a batch are written back-to-back
+  and the responses are then matched to them in order, since the server answers one line per command.
+  messages is a list of (message, recipient) pairs, or (message, recipient, timestamp) triples to keep
+  the time a message was written; returns a list of booleans in the same order.
+  The round trip time of the last batch, in seconds, is kept in last_latency.
+  """
+  def send_many(self, messages:list, batch_size:int=100) -> list:
+    results = []
+    for start in range(0, len(messages), batch_size):
+      batch = messages[start:start + batch_size]
+      cmds = [{"token": self.token, "directmessage": {"entry": item[0], "recipient": item[1],
+                                                        "timestamp": item[2] if len(item) > 2 else self._stamp()}}
+              for item in batch]
+      begin = time.perf_counter()
+      try:
+        results.extend(self._pipeline(cmds))
+      except (OSError, ValueError, ServerTimeoutError) as e:
+        e.answered = results + getattr(e, 'answered', [])
+        raise
+      self.last_latency = time.perf_counter() - begin
+    return results
+
+  """
+  Write a batch of commands and read back their responses in order.
+  If the write fails, reconnect once and write the batch again. Once it has been written, the
+  commands are not sent again: if the answers stop, the error is raised with the results read so
+  far in its `answered` attribute, so the caller knows which messages the server confirmed.
+  """
+  def _pipeline(self, cmds:list) -> list:
+    self._write(cmds)
+    results = []
+    try:
+      for _ in cmds:
+        results.append(self._is_ok(self.server_connect._read_command()))
+    except (OSError, ValueError) as e:
+      error = self._read_failed(e)
+      error.answered = results
+      raise error
+    return results
+
+  """
+  Return true if the server response is of type 'ok'.
+  """
+  def _is_ok(self, res) -> bool:
     try:
       type = self.server_connect.extract_type(res)
       return type.upper() == 'OK'
     except:
       return False
-	
+
   """
-  Returns a list of DirectMessage objects containing all new messages.
+  Returns a list of Message objects containing all new messages.
   """
   def retrieve_new(self) -> list:
+    if self.ingest is not None:
+      self.msg_new = list(self.iter_new())
+      return self.msg_new
     cmd = {"token":self.token, "directmessage": "new"}
-    self.server_connect._write_command(cmd)
-    self.msg_new = self.server_connect.extract_response_msg(self.server_connect._read_command(), request=True)
+    messages = self.server_connect.extract_response_msg(self._request(cmd), request=True)
+    self.msg_new = [Message.from_dict(msg) for msg in messages]
     return self.msg_new
 
   """
-  Returns a list of DirectMessage objects containing all messages.
+  Returns a list of Message objects containing all messages.
   """
   def retrieve_all(self) -> list:
+    if self.ingest is not None:
+      # Streamed, so that messages already seen are dropped without ever being held together.
+      self.msg_all = list(self.iter_all())
+      return self.msg_all
     cmd = {"token":self.token, "directmessage": "all"}
-    self.server_connect._write_command(cmd)
-    self.msg_all = self.server_connect.extract_response_msg(self.server_connect._read_command(), request=True)
-    return self.msg_all
\ No newline at end of file
+    messages = self.server_connect.extract_response_msg(self._request(cmd), request=True)
+    self.msg_all = [Message.from_dict(msg) for msg in messages]
+    return self.msg_all
+
+  """
+  Yields all new messages one at a time as they arrive from the server.
+  The generator must be consumed or closed before the next request is made.
+  """
+  def iter_new(self):
+    return self._ingested(self._stream({"token": self.token, "directmessage": "new"}))
+
+  """
+  Yields all messages one at a time as they arrive from the server, keeping roughly one
+  message in memory instead of the whole history.
+  The generator must be consumed or closed before the next request is made.
+  """
+  def iter_all(self):
+    return self._ingested(self._stream({"token": self.token, "directmessage": "all"}))
+
+  def _ingested(self, messages):
+    return self.ingest.filter(messages) if self.ingest is not None else messages
+
+  """
+  Write a retrieve command and stream the messages of its response.
+  If the socket has dropped before anything arrived, reconnect and re-join once.
+  """
+  def _stream(self, cmd:dict):
+    self._write([cmd])
+    try:
+      messages = self.server_connect._read_messages()
+      first = next(messages, None)
+    except (OSError, ValueError) as e:
+      error = self._read_failed(e)
+      if error is not e:
+        raise error
+      self._write([cmd])
+      messages = self.server_connect._read_messages()
+      first = next(messages, None)
+    if first is not None:
+      yield Message.from_dict(first)
+      try:
+        for msg in messages:
+          yield Message.from_dict(msg)
+      except socket.timeout as e:
+        raise self._read_failed(e)
+
+
+"""
+An asyncio version of DirectMessenger built on asyncio.open_connection.
+Has the same join, send, retrieve_new and retrieve_all behaviour and raises the same exceptions,
+but many instances can share one event loop, so a single process can drive many accounts at once.
+Create it with `await AsyncDirectMessenger.open(dsuserver, username, password)`.
+"""
+class AsyncDirectMessenger:
+  # A retrieve_all response arrives as a single line, so the default 64 KiB stream limit is too small.
+  LINE_LIMIT = 2 ** 26
+
+  def __init__(self, dsuserver=None, username=None, password=None, port='2021',
+               connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, ingest=None):
+    self.token = None
+    self.dsuserver = dsuserver
+    self.port = port
+    self.username = username
+    self.password = password
+    self.msg_all = []
+    self.msg_new = []
+    self.reconnects = 0
+    self.last_latency = None
+    self._last_timestamp = 0.0
+    self._is_new = None
+    self._reader = None
+    self._writer = None
+    self._lock = asyncio.Lock()
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    # An optional ds_ingest.Deduplicator, as for DirectMessenger.
+    self.ingest = ingest
+
+  """
+  Connect and join in one step, returning the ready messenger.
+  """
+  @classmethod
+  async def open(cls, dsuserver, username, password, port='2021', connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, ingest=None):
+    messenger = cls(dsuserver, username, password, port, connect_timeout, read_timeout, ingest)
+    await messenger.connect()
+    return messenger
+
+  async def __aenter__(self):
+    if self._writer is None:
+      await self.connect()
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.close()
+
+  """
+  Open the connection to the dsuserver and join with the stored username and password.
+  """
+  async def connect(self):
+    try:
+      self._reader, self._writer = await asyncio.wait_for(
+        asyncio.open_connection(self.dsuserver, int(self.port), limit=self.LINE_LIMIT), self.connect_timeout)
+    except asyncio.TimeoutError:
+      raise ServerTimeoutError('The server did not answer in time.')
+    except OSError as e:
+      raise _connection_error(e)
+
+    was_new = self._is_new
+    await self.join()
+    if was_new is not None:
+      self._is_new = was_new
+
+  """
+  Join into the server using the stored username and password.
+  Will raise an exception if the server catches an error when joining.
+  """
+  async def join(self):
+    cmd = {"join": {"username": self.username, "password": self.password, "token": None}}
+    try:
+      await self._write_command(cmd)
+      response = await self._read_command()
+    except ConnectionResetError:
+      raise ServerNodeNameError('Wrong SERVER or wrong PORT.')
+    except TimeoutError:
+      raise ServerTimeoutError('The server did not answer in time.')
+    except OSError:
+      raise ProtocolError('Connection Error')
+
+    if response['response']['type'].upper() == 'OK':
+      self.token = response['response']['token']
+      self._is_new = response['response']['message'] == 'Welcome to the ICS 32 Distributed Social!'
+    else:
+      raise InvalidLoginError('Invalid password or username already taken')
+
+  """
+  Close the connection to the dsuserver.
+  """
+  async def close(self):
+    if self._writer is not None:
+      self._writer.close()
+      try:
+        await self._writer.wait_closed()
+      except OSError:
+        pass
+      self._reader = self._writer = None
+
+  """
+  Drop the current connection and join again. Called only when the session is lost.
+  """
+  async def reconnect(self):
+    await self.close()
+    await self.connect()
+    self.reconnects += 1
+
+  """
+  Write command to the server.
+  """
+  async def _write_command(self, cmd):
+    await self._write_commands([cmd])
+
+  """
+  Write several commands to the server with a single drain, without waiting for any response.
+  """
+  async def _write_commands(self, cmds:list):
+    self._writer.write(''.join(json.dumps(cmd) + '\r\n' for cmd in cmds).encode())
+    await self._writer.drain()
+
+  """
+  Read the response message from the server.
+  """
+  async def _read_command(self):
+    try:
+      line = await asyncio.wait_for(self._reader.readline(), self.read_timeout)
+    except asyncio.TimeoutError:
+      # Raised as the built-in TimeoutError, an OSError, so that _request reconnects as for a lost connection.
+      raise TimeoutError('The server did not answer in time.')
+    if not line:
+      raise ConnectionResetError('Connection closed by the server.')
+    return json.loads(line)
+
+  """
+  Write a command and wait for its response, reconnecting once if the connection has dropped.
+  Requests on one connection are serialized, since the protocol answers in order.
+  As in DirectMessenger._request, a command the server may have received is not written again.
+  """
+  async def _request(self, cmd:dict) -> dict:
+    async with self._lock:
+      await self._write([cmd])
+      try:
+        return await self._read_command()
+      except (OSError, ValueError) as e:
+        error = await self._read_failed(e)
+        if error is not e or _command_type(cmd) == 'send':
+          raise error
+      await self._write([cmd])
+      return await self._read_command()
+
+  """
+  Write commands, replacing a connection the server has closed first, and reconnecting and
+  writing once more if the write itself fails. The caller holds the lock.
+  """
+  async def _write(self, cmds:list):
+    if self._reader is None or self._reader.at_eof():
+      await self.reconnect()
+    try:
+      for cmd in cmds:
+        cmd['token'] = self.token
+      await self._write_commands(cmds)
+    except (OSError, AttributeError):
+      await self.reconnect()
+      for cmd in cmds:
+        cmd['token'] = self.token
+      await self._write_commands(cmds)
+
+  """
+  Close the connection after a read failed on commands that were already written, and return the
+  error to raise, as DirectMessenger._read_failed does.
+  """
+  async def _read_failed(self, error:Exception) -> Exception:
+    await self.close()
+    if isinstance(error, TimeoutError):
+      return ServerTimeoutError('The server did not answer in time.')
+    return error
+
+  """
+  Return a timestamp for a new message, later than any this messenger handed out before. The
+  timestamp is part of a message's identity in the store and in ds_ingest, so two messages with the
+  same body and recipient must not share one.
+  """
+  def _stamp(self) -> float:
+    self._last_timestamp = _next_timestamp(self._last_timestamp)
+    return self._last_timestamp
+
+  """
+  Sends direct messages to another user.
+  Returns true if message successfully sent, false if send failed.
+  """
+  async def send(self, message:str, recipient:str) -> bool:
+    cmd = {"token": self.token, "directmessage": {"entry": message, "recipient": recipient, "timestamp": self._stamp()}}
+    start = time.perf_counter()
+    res = await self._request(cmd)
+    self.last_latency = time.perf_counter() - start
+    return self._is_ok(res)
+
+  """
+  Sends many direct messages in pipelined batches, like DirectMessenger.send_many.
+  messages is a list of (message, recipient) pairs or (message, recipient, timestamp) triples;
+  returns a list of booleans in the same order.
+  """
+  async def send_many(self, messages:list, batch_size:int=100) -> list:
+    results = []
+    for start in range(0, len(messages), batch_size):
+      batch = messages[start:start + batch_size]
+      cmds = [{"token": self.token, "directmessage": {"entry": item[0], "recipient": item[1],
+                                                        "timestamp": item[2] if len(item) > 2 else self._stamp()}}
+              for item in batch]
+      begin = time.perf_counter()
+      try:
+        results.extend(await self._pipeline(cmds))
+      except (OSError, ValueError, ServerTimeoutError) as e:
+        e.answered = results + getattr(e, 'answered', [])
+        raise
+      self.last_latency = time.perf_counter() - begin
+    return results
+
+  """
+  Write a batch of commands back-to-back and read their responses in order.
+  As in DirectMessenger._pipeline, the batch is written again only if the write failed; if the
+  answers stop, the error is raised with the results read so far in its `answered` attribute.
+  """
+  async def _pipeline(self, cmds:list) -> list:
+    results = []
+    async with self._lock:
+      await self._write(cmds)
+      try:
+        for _ in cmds:
+          results.append(self._is_ok(await self._read_command()))
+      except (OSError, ValueError) as e:
+        error = await self._read_failed(e)
+        error.answered = results
+        raise error
+    return results
+
+  """
+  Return true if the server response is of type 'ok'.
+  """
+  def _is_ok(self, res) -> bool:
+    try:
+      return res['response']['type'].upper() == 'OK'
+    except (KeyError, TypeError, AttributeError):
+      return False
+
+  """
+  Returns a list of Message objects containing all new messages.
+  """
+  async def retrieve_new(self) -> list:
+    res = await self._request({"token": self.token, "directmessage": "new"})
+    self.msg_new = self._ingested(Message.from_dict(msg) for msg in res['response']['messages'])
+    return self.msg_new
+
+  """
+  Returns a list of Message objects containing all messages.
+  """
+  async def retrieve_all(self) -> list:
+    res = await self._request({"token": self.token, "directmessage": "all"})
+    self.msg_all = self._ingested(Message.from_dict(msg) for msg in res['response']['messages'])
+    return self.msg_all
+
+  def _ingested(self, messages) -> list:
+    return list(self.ingest.filter(messages) if self.ingest is not None else messages)
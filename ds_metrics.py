@@ -0,0 +1,207 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+A latency histogram with power-of-two buckets, from 1 microsecond up.
+Keeps count, total, min and max exactly; percentiles are estimated from the buckets by linear
+interpolation within the bucket they fall in, and clamped to the observed min and max.
+"""
+class Histogram:
+  BUCKETS = 32
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+    self.buckets = [0] * self.BUCKETS
+
+  """
+  Record one duration in seconds.
+  """
+  def observe(self, seconds:float):
+    self.count += 1
+    self.total += seconds
+    if self.min is None or seconds < self.min:
+      self.min = seconds
+    if self.max is None or seconds > self.max:
+      self.max = seconds
+    micros = int(seconds * 1e6)
+    self.buckets[min(micros.bit_length(), self.BUCKETS - 1)] += 1
+
+  """
+  Estimate the p-th percentile in seconds. Bucket i holds the durations from 2**(i-1) up to 2**i
+  microseconds (bucket 0 those under one), assumed spread evenly across it.
+  """
+  def percentile(self, p:float) -> float:
+    if not self.count:
+      return None
+    rank = p / 100 * self.count
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      if n and seen + n >= rank:
+        lower = (1 << (i - 1)) / 1e6 if i else 0.0
+        upper = (1 << i) / 1e6
+        estimate = lower + (upper - lower) * max(0.0, rank - seen) / n
+        return min(max(estimate, self.min), self.max)
+      seen += n
+    return self.max
+
+  def as_dict(self) -> dict:
+    return {
+      'count': self.count,
+      'mean_ms': self.total / self.count * 1000 if self.count else None,
+      'min_ms': self.min * 1000 if self.min is not None else None,
+      'max_ms': self.max * 1000 if self.max is not None else None,
+      'p50_ms': self.percentile(50) * 1000 if self.count else None,
+      'p90_ms': self.percentile(90) * 1000 if self.count else None,
+      'p99_ms': self.percentile(99) * 1000 if self.count else None,
+    }
+
+
+"""
+Collects counters and latency histograms for the client.
+DirectMessage reports every command it writes and reads here: per command type latency,
+bytes in and out, and error counts, along with join durations and reconnects.
+When profiling is on, functions wrapped with profiled() are timed as well.
+"""
+class Metrics:
+  def __init__(self):
+    self.profiling = False
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._histograms = {}
+    self._dump_timer = None
+
+  """
+  Add n to a counter.
+  """
+  def incr(self, name:str, n:int=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + n
+
+  """
+  Record a duration in seconds in a histogram.
+  """
+  def observe(self, name:str, seconds:float):
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = Histogram()
+      histogram.observe(seconds)
+
+  """
+  Time the body of a with statement into a histogram.
+  """
+  @contextmanager
+  def timer(self, name:str):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - start)
+
+  """
+  Return the value of a counter.
+  """
+  def counter(self, name:str) -> int:
+    with self._lock:
+      return self._counters.get(name, 0)
+
+  """
+  Return the histogram recorded under name, or None.
+  """
+  def histogram(self, name:str) -> Histogram:
+    with self._lock:
+      return self._histograms.get(name)
+
+  """
+  Return every counter and histogram summary as a JSON-ready dict.
+  """
+  def snapshot(self) -> dict:
+    with self._lock:
+      return {
+        'time': time.time(),
+        'counters': dict(self._counters),
+        'histograms': {name: h.as_dict() for name, h in self._histograms.items()},
+      }
+
+  """
+  Forget everything recorded so far.
+  """
+  def reset(self):
+    with self._lock:
+      self._counters.clear()
+      self._histograms.clear()
+
+  """
+  Write a snapshot to a JSON file, replacing it atomically.
+  """
+  def dump(self, path:str):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(self.snapshot(), f, indent=2)
+    os.replace(tmp, path)
+
+  """
+  Dump a snapshot to path every interval seconds, on a daemon timer thread.
+  """
+  def start_dump(self, path:str, interval:float=10.0):
+    self.stop_dump()
+
+    def tick():
+      self.dump(path)
+      self._dump_timer = threading.Timer(interval, tick)
+      self._dump_timer.daemon = True
+      self._dump_timer.start()
+
+    self._dump_timer = threading.Timer(interval, tick)
+    self._dump_timer.daemon = True
+    self._dump_timer.start()
+
+  """
+  Stop the periodic dump started with start_dump.
+  """
+  def stop_dump(self):
+    if self._dump_timer is not None:
+      self._dump_timer.cancel()
+      self._dump_timer = None
+
+
+"""
+The metrics the client reports to unless another object is plugged in with set_metrics.
+Profiling is turned on by setting the DSP_PROFILE environment variable.
+"""
+metrics = Metrics()
+metrics.profiling = bool(os.environ.get('DSP_PROFILE'))
+
+
+"""
+Replace the metrics the client reports to. Any object with incr and observe methods can be used.
+"""
+def set_metrics(new_metrics):
+  global metrics
+  metrics = new_metrics
+
+
+"""
+A decorator that times every call of the function into the histogram `name` while profiling is on.
+"""
+def profiled(name:str):
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      current = metrics
+      if not getattr(current, 'profiling', False):
+        return func(*args, **kwargs)
+      start = time.perf_counter()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        current.observe(name, time.perf_counter() - start)
+    return wrapper
+  return decorator
@@ -0,0 +1,71 @@
+import time
+
+"""
+A durable queue of outgoing messages in front of DirectMessenger.send.
+Messages are written to the outbox of a MessageStore before anything goes on the wire, so they
+survive a lost connection or a restart. flush sends everything pending in queue order, in
+pipelined batches over one connection, which keeps the order of the messages to each recipient.
+"""
+class OutboundQueue:
+  BATCH_SIZE = 100
+
+  def __init__(self, store, account:str):
+    self.store = store
+    self.account = account
+
+  """
+  Queue a message for recipient. Returns its id in the outbox.
+  """
+  def enqueue(self, message:str, recipient:str, timestamp:float=None) -> int:
+    if timestamp is None:
+      timestamp = time.time()
+    return self.store.enqueue(self.account, recipient, message, timestamp)
+
+  """
+  Return the number of messages waiting to be sent.
+  """
+  def depth(self) -> int:
+    return self.store.outbox_stats(self.account)[0]
+
+  """
+  Return how many seconds the oldest waiting message has been queued, or None if the queue is empty.
+  """
+  def oldest_age(self) -> float:
+    oldest = self.store.outbox_stats(self.account)[1]
+    return None if oldest is None else max(0.0, time.time() - oldest)
+
+  """
+  Send every queued message through messenger, one pipelined batch at a time.
+  Each batch is removed from the queue once the server has answered it; messages the server
+  rejects are dropped and returned, since sending them again would not succeed.
+  A connection failure is raised with the unanswered part of the batch still queued. Those messages
+  may have reached the server before the answers stopped; they keep their original timestamp when
+  sent again, so the receiving store and ds_ingest see the same message rather than a new one.
+  Returns a (sent, rejected) pair of lists of (recipient, message, timestamp). When a connection
+  failure is raised, the pair for the messages answered before it is in the exception's `flushed`
+  attribute, so rejected ones can still be cleaned up.
+  """
+  def flush(self, messenger) -> tuple:
+    sent = []
+    rejected = []
+    while True:
+      rows = self.store.outbox(self.account, self.BATCH_SIZE)
+      if not rows:
+        return sent, rejected
+      try:
+        results = messenger.send_many([(message, recipient, timestamp) for _, recipient, message, timestamp in rows],
+                                      self.BATCH_SIZE)
+      except Exception as e:
+        answered = getattr(e, 'answered', None)
+        if answered:
+          self.store.dequeue([row[0] for row in rows[:len(answered)]])
+          self._split(rows, answered, sent, rejected)
+        e.flushed = (sent, rejected)
+        raise
+      self.store.dequeue([row[0] for row in rows])
+      self._split(rows, results, sent, rejected)
+
+  @staticmethod
+  def _split(rows, results, sent, rejected):
+    for (_, recipient, message, timestamp), ok in zip(rows, results):
+      (sent if ok else rejected).append((recipient, message, timestamp))
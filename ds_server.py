@@ -0,0 +1,212 @@
+import argparse
+import json
+import queue
+import random
+import socketserver
+import threading
+import time
+import uuid
+
+WELCOME_NEW = 'Welcome to the ICS 32 Distributed Social!'
+
+"""
+Holds the accounts, tokens and inboxes of a DSPServer. All access goes through one lock.
+"""
+class _State:
+  def __init__(self, history_size:int=0, senders:int=10):
+    self.history_size = history_size
+    self.senders = senders
+    self.passwords = {}
+    self.tokens = {}
+    self.inbox = {}
+    self.unread = {}
+    self.lock = threading.Lock()
+
+  def join(self, username, password) -> dict:
+    with self.lock:
+      if not username or not password:
+        return _error('Invalid password or username already taken')
+      known = self.passwords.get(username)
+      if known is not None and known != password:
+        return _error('Invalid password or username already taken')
+      if known is None:
+        self.passwords[username] = password
+        self.inbox[username] = self._history(username) + self.inbox.get(username, [])
+        self.unread[username] = 0
+        message = WELCOME_NEW
+      else:
+        message = f'Welcome back, {username}'
+      token = str(uuid.uuid4())
+      self.tokens[token] = username
+      return {"response": {"type": "ok", "message": message, "token": token}}
+
+  def _history(self, username) -> list:
+    start = time.time() - self.history_size
+    return [{"message": f"Synthetic message {i} for {username}", "from": f"sender{i % self.senders}",
+             "timestamp": str(start + i)}
+            for i in range(self.history_size)]
+
+  def directmessage(self, token, request) -> dict:
+    with self.lock:
+      username = self.tokens.get(token)
+      if username is None:
+        return _error('Invalid user token.')
+      if request == 'all':
+        return {"response": {"type": "ok", "messages": list(self.inbox[username])}}
+      if request == 'new':
+        inbox = self.inbox[username]
+        messages = inbox[self.unread[username]:]
+        self.unread[username] = len(inbox)
+        return {"response": {"type": "ok", "messages": messages}}
+      if isinstance(request, dict) and {'entry', 'recipient', 'timestamp'} <= request.keys():
+        recipient = request['recipient']
+        if recipient not in self.inbox:
+          self.inbox[recipient] = []
+          self.unread[recipient] = 0
+        self.inbox[recipient].append(
+          {"message": request['entry'], "from": username, "timestamp": str(request['timestamp'])})
+        return {"response": {"type": "ok", "message": "Direct message sent"}}
+      return _error('Invalid direct message request.')
+
+
+def _error(message:str) -> dict:
+  return {"response": {"type": "error", "message": message}}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+  # Responses are written one small line at a time; without this, Nagle's algorithm holds them back
+  # behind the client's delayed ACKs and pipelined batches stall.
+  disable_nagle_algorithm = True
+
+  def handle(self):
+    server = self.server
+    # Each response is due a fixed delay after its command arrived, and a writer thread sends
+    # them in order, so pipelined commands pay the artificial latency once rather than once each.
+    outgoing = queue.Queue()
+    writer = threading.Thread(target=self._write_responses, args=(outgoing,), daemon=True)
+    writer.start()
+    try:
+      for line in self.rfile:
+        try:
+          cmd = json.loads(line)
+        except ValueError:
+          response = _error('Invalid JSON.')
+        else:
+          if not isinstance(cmd, dict):
+            response = _error('Unknown command.')
+          elif 'join' in cmd:
+            join = cmd['join']
+            response = server.state.join(join.get('username'), join.get('password'))
+          elif 'directmessage' in cmd:
+            response = server.state.directmessage(cmd.get('token'), cmd['directmessage'])
+          else:
+            response = _error('Unknown command.')
+        outgoing.put((time.monotonic() + server.delay(), response))
+    except ConnectionResetError:
+      pass
+    finally:
+      outgoing.put(None)
+      writer.join()
+
+  def _write_responses(self, outgoing):
+    while True:
+      item = outgoing.get()
+      if item is None:
+        return
+      due, response = item
+      wait = due - time.monotonic()
+      if wait > 0:
+        time.sleep(wait)
+      try:
+        self.wfile.write((json.dumps(response) + '\r\n').encode())
+      except OSError:
+        return
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+  # The default backlog of 5 drops SYNs when many clients connect at once, which stalls each of
+  # them for a one second retransmit.
+  request_queue_size = 128
+
+
+"""
+A local stand-in for the DSP server that speaks the same JSON-lines protocol as the
+remote one: join with tokens and the new-user welcome message, direct messages, and
+retrieval of new and all messages, including the error responses.
+Responses can be delayed by an artificial latency with random jitter, and every new
+account can be given a synthetic history of history_size messages from `senders` users.
+Use it in-process with start()/stop() or as a context manager, or run this module to serve
+from a separate process.
+"""
+class DSPServer:
+  def __init__(self, host:str='127.0.0.1', port:int=0, latency:float=0.0, jitter:float=0.0,
+               history_size:int=0, senders:int=10):
+    self.latency = latency
+    self.jitter = jitter
+    self._server = _TCPServer((host, int(port)), _Handler)
+    self._server.state = _State(history_size, senders)
+    self._server.delay = self._delay
+    self._thread = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  """
+  The (host, port) the server is listening on, as strings ready to pass to DirectMessenger.
+  """
+  @property
+  def address(self) -> tuple:
+    host, port = self._server.server_address[:2]
+    return host, str(port)
+
+  def _delay(self) -> float:
+    if self.jitter:
+      return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+    return self.latency
+
+  """
+  Serve on a background thread and return the server.
+  """
+  def start(self):
+    self._thread = threading.Thread(target=self._server.serve_forever, name='dsp-server', daemon=True)
+    self._thread.start()
+    return self
+
+  """
+  Serve on the calling thread until interrupted.
+  """
+  def serve_forever(self):
+    self._server.serve_forever()
+
+  """
+  Stop serving and close the listening socket.
+  """
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Run a local stand-in DSP server.')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=2021)
+  parser.add_argument('--latency', type=float, default=0.0, help='artificial response delay in seconds')
+  parser.add_argument('--jitter', type=float, default=0.0, help='random +/- variation of the delay in seconds')
+  parser.add_argument('--history', type=int, default=0, help='synthetic messages given to every new account')
+  parser.add_argument('--senders', type=int, default=10, help='number of synthetic senders in that history')
+  args = parser.parse_args()
+
+  server = DSPServer(args.host, args.port, args.latency, args.jitter, args.history, args.senders)
+  print(f'Serving DSP on {args.host}:{server.address[1]}', flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,199 @@
+import asyncio
+import time
+
+import ds_ingest
+import ds_messenger as dsm
+
+"""
+A token bucket that limits how many commands one account sends to the server.
+Tokens refill at `rate` per second up to `burst`; acquire waits until enough are available.
+"""
+class RateLimiter:
+  def __init__(self, rate:float, burst:int=None):
+    self.rate = rate
+    self.burst = burst if burst is not None else max(1, int(rate))
+    self._tokens = float(self.burst)
+    self._updated = time.monotonic()
+    self._lock = asyncio.Lock()
+
+  def _refill(self):
+    now = time.monotonic()
+    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+  """
+  Wait until n tokens are available and take them. n is capped at the burst size.
+  """
+  async def acquire(self, n:int=1):
+    n = min(n, self.burst)
+    async with self._lock:
+      self._refill()
+      while self._tokens < n:
+        await asyncio.sleep((n - self._tokens) / self.rate)
+        self._refill()
+      self._tokens -= n
+
+
+"""
+Holds many logged-in accounts in one process, each on its own AsyncDirectMessenger connection,
+and drives them concurrently on one event loop.
+Every command an account sends first takes a token from that account's RateLimiter, so no account
+sends more than `rate` commands per second to the shared server however the manager is used.
+At most `connect_concurrency` joins are in progress at once when accounts are opened.
+connect_timeout and read_timeout are the deadlines of every connection, as for DirectMessenger.
+With dedup_capacity, each account gets a ds_ingest.Deduplicator of that size, so retrieve_new and
+poll never hand on a message twice, even across reconnects.
+"""
+class SessionManager:
+  def __init__(self, dsuserver:str, port:str='2021', rate:float=20.0, burst:int=None,
+               connect_concurrency:int=10, dedup_capacity:int=None,
+               connect_timeout:float=dsm.CONNECT_TIMEOUT, read_timeout:float=dsm.READ_TIMEOUT):
+    self.dsuserver = dsuserver
+    self.port = port
+    self.rate = rate
+    self.burst = burst
+    self.dedup_capacity = dedup_capacity
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.sessions = {}
+    self.limits = {}
+    self.last_errors = {}
+    self._connecting = asyncio.Semaphore(connect_concurrency)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.close()
+
+  def __len__(self):
+    return len(self.sessions)
+
+  def __contains__(self, username):
+    return username in self.sessions
+
+  """
+  Log in one account and add it to the manager. Returns its messenger.
+  Raises the same exceptions as AsyncDirectMessenger.open.
+  """
+  async def add(self, username:str, password:str):
+    ingest = ds_ingest.Deduplicator(self.dedup_capacity) if self.dedup_capacity else None
+    async with self._connecting:
+      messenger = await dsm.AsyncDirectMessenger.open(self.dsuserver, username, password, self.port,
+                                                      self.connect_timeout, self.read_timeout, ingest)
+    old = self.sessions.get(username)
+    if old is not None:
+      await old.close()
+    self.sessions[username] = messenger
+    self.limits[username] = RateLimiter(self.rate, self.burst)
+    return messenger
+
+  """
+  Log in many accounts concurrently from (username, password) pairs.
+  Returns a dict of the usernames that could not log in to their exception.
+  """
+  async def add_all(self, accounts) -> dict:
+    accounts = list(accounts)
+    results = await asyncio.gather(*(self.add(username, password) for username, password in accounts),
+                                   return_exceptions=True)
+    return {username: result for (username, _), result in zip(accounts, results)
+            if isinstance(result, BaseException)}
+
+  """
+  Log out one account and close its connection.
+  """
+  async def remove(self, username:str):
+    messenger = self.sessions.pop(username, None)
+    self.limits.pop(username, None)
+    if messenger is not None:
+      await messenger.close()
+
+  """
+  Send one direct message from account username.
+  """
+  async def send(self, username:str, message:str, recipient:str) -> bool:
+    await self.limits[username].acquire()
+    return await self.sessions[username].send(message, recipient)
+
+  """
+  Send the same message from account username to every recipient, pipelined in batches no larger
+  than the account's burst so the rate limit holds. Returns a list of booleans in recipient order.
+  """
+  async def fan_out(self, username:str, message:str, recipients:list) -> list:
+    messenger = self.sessions[username]
+    limiter = self.limits[username]
+    results = []
+    for start in range(0, len(recipients), limiter.burst):
+      batch = recipients[start:start + limiter.burst]
+      await limiter.acquire(len(batch))
+      # No timestamp is given, so send_many stamps every copy with its own.
+      results.extend(await messenger.send_many([(message, recipient) for recipient in batch], limiter.burst))
+    return results
+
+  """
+  Send (username, message, recipient) triples, each account sending its own in order while the
+  accounts run concurrently. Returns a list of booleans in the same order as items.
+  """
+  async def send_all(self, items) -> list:
+    items = list(items)
+    by_account = {}
+    for i, (username, message, recipient) in enumerate(items):
+      by_account.setdefault(username, []).append((i, message, recipient))
+
+    results = [False] * len(items)
+
+    async def send_account(username, rows):
+      messenger = self.sessions[username]
+      limiter = self.limits[username]
+      for start in range(0, len(rows), limiter.burst):
+        batch = rows[start:start + limiter.burst]
+        await limiter.acquire(len(batch))
+        oks = await messenger.send_many([(message, recipient) for _, message, recipient in batch], limiter.burst)
+        for (i, _, _), ok in zip(batch, oks):
+          results[i] = ok
+
+    await asyncio.gather(*(send_account(username, rows) for username, rows in by_account.items()))
+    return results
+
+  """
+  Retrieve the new messages of every account concurrently.
+  Returns a dict of username to its list of new Messages; accounts whose request failed are
+  left out and their exceptions are kept in last_errors.
+  """
+  async def retrieve_new(self) -> dict:
+    usernames = list(self.sessions)
+
+    async def retrieve(username):
+      await self.limits[username].acquire()
+      return await self.sessions[username].retrieve_new()
+
+    results = await asyncio.gather(*(retrieve(username) for username in usernames), return_exceptions=True)
+    self.last_errors = {}
+    new = {}
+    for username, result in zip(usernames, results):
+      if isinstance(result, BaseException):
+        self.last_errors[username] = result
+      else:
+        new[username] = result
+    return new
+
+  """
+  Call retrieve_new every interval seconds until cancelled, passing on_messages a dict of only the
+  accounts that received something.
+  """
+  async def poll(self, on_messages, interval:float=5.0):
+    while True:
+      start = time.monotonic()
+      new = {username: messages for username, messages in (await self.retrieve_new()).items() if messages}
+      if new:
+        on_messages(new)
+      await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+  """
+  Close every connection.
+  """
+  async def close(self):
+    sessions = list(self.sessions.values())
+    self.sessions.clear()
+    self.limits.clear()
+    await asyncio.gather(*(messenger.close() for messenger in sessions), return_exceptions=True)
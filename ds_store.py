@@ -0,0 +1,315 @@
+import os
+import sqlite3
+import threading
+import time
+from ds_messenger import Message
+
+"""
+The default location of the local message store.
+"""
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.ds_messenger', 'messages.db')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+  account TEXT PRIMARY KEY,
+  seeded INTEGER NOT NULL DEFAULT 0,
+  synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS messages (
+  id INTEGER PRIMARY KEY,
+  account TEXT NOT NULL,
+  sender TEXT NOT NULL,
+  message TEXT NOT NULL,
+  timestamp REAL NOT NULL,
+  recipient TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_by_sender ON messages (account, sender, timestamp);
+CREATE INDEX IF NOT EXISTS messages_by_time ON messages (account, timestamp);
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY,
+  account TEXT NOT NULL,
+  recipient TEXT NOT NULL,
+  message TEXT NOT NULL,
+  timestamp REAL NOT NULL
+);
+"""
+
+# The full-text index over message bodies. Only created when the SQLite build has FTS5; search
+# falls back to a LIKE scan otherwise. New rows are indexed by add_messages in one statement per
+# batch, which is several times faster than an insert trigger firing once per row.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE messages_fts USING fts5(message, content='messages', content_rowid='id');
+CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+  INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+END;
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+"""
+
+# A message is identified by its sender, timestamp, body and recipient, as in ds_ingest.message_key,
+# so the same text sent to two users, or sent to oneself and received back, is kept twice.
+_IDENTITY_INDEX = """
+CREATE UNIQUE INDEX IF NOT EXISTS messages_identity
+  ON messages (account, sender, timestamp, message, COALESCE(recipient, ''));
+"""
+
+# Stores created before the recipient was part of a message's identity have a table-level UNIQUE
+# constraint without it, which SQLite can only drop by copying the table. Rows keep their ids; the
+# full-text index, whose delete trigger goes with the old table, is built again afterwards.
+_DROP_OLD_UNIQUE = """
+BEGIN;
+CREATE TABLE messages_new (
+  id INTEGER PRIMARY KEY,
+  account TEXT NOT NULL,
+  sender TEXT NOT NULL,
+  message TEXT NOT NULL,
+  timestamp REAL NOT NULL,
+  recipient TEXT
+);
+INSERT INTO messages_new (id, account, sender, message, timestamp, recipient)
+  SELECT id, account, sender, message, timestamp, recipient FROM messages;
+DROP TABLE messages;
+ALTER TABLE messages_new RENAME TO messages;
+DROP TABLE IF EXISTS messages_fts;
+COMMIT;
+"""
+
+
+"""
+Build the key under which an account's messages are stored.
+"""
+def account_key(username:str, dsuserver:str) -> str:
+  return f'{username}@{dsuserver}'
+
+
+"""
+A local on-disk copy of the messages retrieved from the server, kept in SQLite and keyed by account.
+The store is seeded once from retrieve_all and kept current with retrieve_new, so later launches
+start from the local copy and only ask the server for new messages.
+Messages are stored and returned as ds_messenger.Message records, and messages the user sent
+are stored with their recipient.
+"""
+class MessageStore:
+  def __init__(self, path:str=DEFAULT_PATH):
+    if path != ':memory:':
+      os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.path = path
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.executescript(_SCHEMA)
+    columns = [row[1] for row in self._db.execute('PRAGMA table_info(messages)')]
+    if 'recipient' not in columns:
+      # Stores created before sent messages were recorded.
+      self._db.execute('ALTER TABLE messages ADD COLUMN recipient TEXT')
+    self._create_identity_index()
+    self.has_fts = self._create_fts()
+
+  def _create_identity_index(self):
+    table = self._db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages'").fetchone()[0]
+    if 'UNIQUE' in table:
+      self._db.executescript(_DROP_OLD_UNIQUE)
+      self._db.executescript(_SCHEMA)
+    self._db.executescript(_IDENTITY_INDEX)
+
+  def _create_fts(self) -> bool:
+    if self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+      return True
+    try:
+      with self._db:
+        self._db.executescript(_FTS_SCHEMA)
+    except sqlite3.OperationalError:
+      return False
+    return True
+
+  """
+  Return true if the account has already been seeded from retrieve_all.
+  """
+  def is_seeded(self, account:str) -> bool:
+    with self._lock:
+      row = self._db.execute('SELECT seeded FROM accounts WHERE account = ?', (account,)).fetchone()
+    return bool(row and row[0])
+
+  """
+  Record that the account holds the full history and can be kept current with retrieve_new.
+  """
+  def mark_seeded(self, account:str):
+    with self._lock, self._db:
+      self._db.execute(
+        'INSERT INTO accounts (account, seeded, synced_at) VALUES (?, 1, ?) '
+        'ON CONFLICT (account) DO UPDATE SET seeded = 1, synced_at = excluded.synced_at',
+        (account, time.time()))
+
+  """
+  Add Messages to the account. Messages already in the store are ignored.
+  Returns the messages that were actually added.
+  """
+  def add_messages(self, account:str, messages) -> list:
+    added = []
+    with self._lock, self._db:
+      last_id = self._db.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+      insert = self._db.cursor()
+      for msg in messages:
+        insert.execute(
+          'INSERT OR IGNORE INTO messages (account, sender, message, timestamp, recipient) VALUES (?, ?, ?, ?, ?)',
+          (account, msg.sender, msg.body, msg.timestamp, msg.recipient))
+        if insert.rowcount:
+          added.append(msg)
+      if added and self.has_fts:
+        self._db.execute(
+          'INSERT INTO messages_fts (rowid, message) SELECT id, message FROM messages WHERE id > ?', (last_id,))
+    return added
+
+  """
+  Delete Messages from the account, such as sent messages the server rejected.
+  Returns the number of messages deleted.
+  """
+  def remove_messages(self, account:str, messages) -> int:
+    with self._lock, self._db:
+      cursor = self._db.executemany(
+        'DELETE FROM messages WHERE account = ? AND sender = ? AND timestamp = ? AND message = ? AND recipient IS ?',
+        ((account, msg.sender, msg.timestamp, msg.body, msg.recipient) for msg in messages))
+      return cursor.rowcount
+
+  """
+  Bring the account up to date with the server through a DirectMessenger.
+  The first sync seeds the account with retrieve_all, later ones only fetch retrieve_new.
+  Messages are streamed into the store as they arrive and committed in batches of batch_size;
+  on_batch, if given, is called with the messages added by each batch.
+  Returns the messages that were added.
+  """
+  def sync(self, account:str, messenger, on_batch=None, batch_size:int=1000) -> list:
+    seeded = self.is_seeded(account)
+    stream = messenger.iter_new() if seeded else messenger.iter_all()
+    added = []
+    batch = []
+    for msg in stream:
+      batch.append(msg)
+      if len(batch) >= batch_size:
+        added.extend(self._add_batch(account, batch, on_batch))
+        batch = []
+    added.extend(self._add_batch(account, batch, on_batch))
+    if not seeded:
+      self.mark_seeded(account)
+    return added
+
+  def _add_batch(self, account, batch, on_batch) -> list:
+    added = self.add_messages(account, batch) if batch else []
+    if added and on_batch is not None:
+      on_batch(added)
+    return added
+
+  """
+  Return every message of the account, oldest first.
+  """
+  def load(self, account:str) -> list:
+    with self._lock:
+      rows = self._db.execute(
+        'SELECT sender, message, timestamp, recipient FROM messages WHERE account = ? ORDER BY timestamp',
+        (account,)).fetchall()
+    return [Message(sender, timestamp, message, recipient) for sender, message, timestamp, recipient in rows]
+
+  """
+  Return the id of the newest row in the store, or 0 if it is empty.
+  """
+  def last_id(self) -> int:
+    with self._lock:
+      return self._db.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+
+  """
+  Yield every message of the account, oldest first, in lists of at most batch_size messages.
+  Each batch is a separate query, so the store is not locked while the batches are consumed.
+  With until, only rows up to that id are returned, so messages added while the batches are
+  consumed are left out.
+  """
+  def load_batches(self, account:str, batch_size:int=1000, until:int=None):
+    after = (float('-inf'), 0)
+    if until is None:
+      until = self.last_id()
+    while True:
+      with self._lock:
+        rows = self._db.execute(
+          'SELECT id, sender, message, timestamp, recipient FROM messages '
+          'WHERE account = ? AND (timestamp, id) > (?, ?) AND id <= ? ORDER BY timestamp, id LIMIT ?',
+          (account, after[0], after[1], until, batch_size)).fetchall()
+      if not rows:
+        return
+      after = (rows[-1][3], rows[-1][0])
+      yield [Message(sender, timestamp, message, recipient) for _, sender, message, timestamp, recipient in rows]
+
+  """
+  Find the messages of the account containing every word of query, best matches first.
+  Each word also matches as a prefix, and FTS5 syntax in the query is treated as plain text.
+  Without FTS5, matching messages are returned newest first.
+  """
+  def search(self, account:str, query:str, limit:int=20) -> list:
+    words = query.split()
+    if not words:
+      return []
+    with self._lock:
+      if self.has_fts:
+        match = ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+        rows = self._db.execute(
+          'SELECT m.sender, m.message, m.timestamp, m.recipient FROM messages_fts f '
+          'JOIN messages m ON m.id = f.rowid '
+          'WHERE messages_fts MATCH ? AND m.account = ? ORDER BY f.rank LIMIT ?',
+          (match, account, limit)).fetchall()
+      else:
+        like = ' AND '.join(["message LIKE ? ESCAPE '\\'"] * len(words))
+        patterns = ['%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for word in words]
+        rows = self._db.execute(
+          f'SELECT sender, message, timestamp, recipient FROM messages WHERE account = ? AND {like} '
+          'ORDER BY timestamp DESC LIMIT ?',
+          (account, *patterns, limit)).fetchall()
+    return [Message(sender, timestamp, message, recipient) for sender, message, timestamp, recipient in rows]
+
+  """
+  Return the messages the account received from one user, oldest first.
+  """
+  def messages_from(self, account:str, sender:str) -> list:
+    with self._lock:
+      rows = self._db.execute(
+        'SELECT message, timestamp FROM messages WHERE account = ? AND sender = ? AND recipient IS NULL '
+        'ORDER BY timestamp',
+        (account, sender)).fetchall()
+    return [Message(sender, timestamp, message) for message, timestamp in rows]
+
+  """
+  Persist a message waiting to be sent. Returns its id in the outbox.
+  """
+  def enqueue(self, account:str, recipient:str, message:str, timestamp:float) -> int:
+    with self._lock, self._db:
+      cursor = self._db.execute(
+        'INSERT INTO outbox (account, recipient, message, timestamp) VALUES (?, ?, ?, ?)',
+        (account, recipient, message, timestamp))
+      return cursor.lastrowid
+
+  """
+  Return the messages of the account waiting to be sent, as (id, recipient, message, timestamp) rows
+  in the order they were queued.
+  """
+  def outbox(self, account:str, limit:int=-1) -> list:
+    with self._lock:
+      return self._db.execute(
+        'SELECT id, recipient, message, timestamp FROM outbox WHERE account = ? ORDER BY id LIMIT ?',
+        (account, limit)).fetchall()
+
+  """
+  Return how many messages of the account are waiting to be sent, and the time the oldest was queued.
+  """
+  def outbox_stats(self, account:str) -> tuple:
+    with self._lock:
+      return self._db.execute(
+        'SELECT COUNT(*), MIN(timestamp) FROM outbox WHERE account = ?', (account,)).fetchone()
+
+  """
+  Remove sent messages from the outbox.
+  """
+  def dequeue(self, ids:list):
+    with self._lock, self._db:
+      self._db.executemany('DELETE FROM outbox WHERE id = ?', ((i,) for i in ids))
+
+  """
+  Close the database.
+  """
+  def close(self):
+    with self._lock:
+      self._db.close()
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The ds_* modules live flat at the top of the repository.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ds_server
+
+
+"""
+A DSPServer serving on a free local port for the duration of one test.
+"""
+@pytest.fixture
+def server():
+  with ds_server.DSPServer() as server:
+    yield server
@@ -0,0 +1,38 @@
+import io
+
+import ds_cli
+import ds_messenger as dsm
+
+
+def test_read_rows_json_and_csv():
+  rows = list(ds_cli.read_rows(io.StringIO('\n{"recipient": "bob", "message": "hi", "timestamp": 5}\n[1]\n')))
+  assert rows[0] == (2, ('hi', 'bob', 5.0))
+  assert isinstance(rows[1][1], ds_cli.RowError)
+  rows = list(ds_cli.read_rows(io.StringIO('recipient,message\nbob,"hello, there",7\n,missing\n')))
+  assert rows[0] == (2, ('hello, there', 'bob', 7.0))
+  assert isinstance(rows[1][1], ds_cli.RowError)
+
+
+def test_send_rows_counts_a_failure_mid_run(server):
+  host, port = server.address
+  messenger = dsm.DirectMessenger(host, 'alice', 'pw', port, read_timeout=0.2)
+  send_many = messenger.send_many
+  calls = []
+
+  def stall_second_batch(*args):
+    calls.append(args)
+    if len(calls) == 2:
+      server.latency = 0.5
+    return send_many(*args)
+
+  messenger.send_many = stall_second_batch
+  err = io.StringIO()
+  try:
+    sent, failed, _ = ds_cli.send_rows(messenger, io.StringIO(''.join(f'bob,message {n}\n' for n in range(25))),
+                                       batch_size=10, err=err)
+  finally:
+    server.latency = 0.0
+    messenger.close()
+  assert (sent, failed) == (10, 10)
+  assert len(calls) == 2
+  assert 'line 11: not sent' in err.getvalue()
@@ -0,0 +1,51 @@
+from ds_conversation import Conversation, ConversationIndex
+from ds_messenger import Message
+
+
+def _conversation() -> Conversation:
+  conversation = Conversation()
+  for n in range(10):
+    if n % 3:
+      conversation.add(Message('bob', float(n), f'received {n}'))
+    else:
+      conversation.add(Message('alice', float(n), f'sent {n}', 'bob'))
+  return conversation
+
+
+def test_latest_pages_back_through_both_streams():
+  conversation = _conversation()
+  assert len(conversation) == 10
+  assert [msg.timestamp for msg in conversation.latest(4)] == [6.0, 7.0, 8.0, 9.0]
+  assert [msg.timestamp for msg in conversation.latest(4, 4)] == [2.0, 3.0, 4.0, 5.0]
+  assert [msg.timestamp for msg in conversation.latest(4, 8)] == [0.0, 1.0]
+  assert conversation.latest(4, 12) == []
+  assert [msg.timestamp for msg in conversation] == [float(n) for n in range(10)]
+
+
+def test_add_out_of_order_lands_in_place():
+  conversation = _conversation()
+  conversation.add(Message('bob', 4.5, 'late'))
+  assert [msg.body for msg in conversation.latest(3, 4)] == ['received 4', 'late', 'received 5']
+  assert conversation.last_activity == 9.0
+
+
+def test_remove_takes_out_only_the_matching_message():
+  conversation = _conversation()
+  conversation.add(Message('alice', 3.0, 'other body at the same time', 'bob'))
+  assert conversation.remove(Message('alice', 3.0, 'sent 3', 'bob'))
+  assert [msg.body for msg in conversation if msg.timestamp == 3.0] == ['other body at the same time']
+  assert not conversation.remove(Message('alice', 3.0, 'sent 3', 'bob'))
+  # A received message with the same time and body is in the other stream.
+  assert not conversation.remove(Message('bob', 6.0, 'sent 6'))
+  assert len(conversation) == 10
+
+
+def test_index_groups_by_peer_and_removes():
+  index = ConversationIndex([Message('bob', 1.0, 'hi'), Message('alice', 2.0, 'hey', 'bob'),
+                             Message('carol', 3.0, 'yo')])
+  assert index.users() == ['bob', 'carol']
+  assert index.extend([Message('alice', 4.0, 'hello', 'dave'), Message('bob', 5.0, 'again')]) == {'dave': 1, 'bob': 1}
+  assert index.remove([Message('alice', 2.0, 'hey', 'bob'), Message('alice', 9.0, 'never sent', 'bob')]) == {'bob': 1}
+  assert [msg.body for msg in index.messages('bob')] == ['hi', 'again']
+  assert 'erin' not in index
+  assert len(index.messages('erin')) == 0
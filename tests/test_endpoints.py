@@ -0,0 +1,48 @@
+import socket
+
+import ds_endpoints
+
+
+def test_parse_endpoints():
+  assert ds_endpoints.parse_endpoints('a.example, b.example:2022,,10.0.0.1:99') == [
+    ('a.example', '2021'), ('b.example', '2022'), ('10.0.0.1', '99')]
+  assert ds_endpoints.parse_endpoints('::1, [::1]:5, [fe80::1]', '7') == [('::1', '7'), ('::1', '5'), ('fe80::1', '7')]
+
+
+def test_endpoint_cache_orders_fastest_then_untried_then_failed(tmp_path):
+  path = str(tmp_path / 'endpoints.json')
+  cache = ds_endpoints.EndpointCache(path)
+  endpoints = [('a', '1'), ('b', '1'), ('c', '1'), ('d', '1'), ('e', '1')]
+  assert cache.order(endpoints) == endpoints
+  cache.record(('a', '1'), None)
+  cache.record(('c', '1'), 0.05)
+  cache.record(('e', '1'), 0.01)
+  expected = [('e', '1'), ('c', '1'), ('b', '1'), ('d', '1'), ('a', '1')]
+  assert cache.order(endpoints) == expected
+  # The file is read back by the next session.
+  assert ds_endpoints.EndpointCache(path).order(endpoints) == expected
+
+
+def test_endpoint_cache_survives_a_broken_file(tmp_path):
+  path = tmp_path / 'endpoints.json'
+  path.write_text('{not json')
+  assert ds_endpoints.EndpointCache(str(path)).order([('a', '1')]) == [('a', '1')]
+
+
+def _closed_port() -> str:
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return str(port)
+
+
+def test_race_connects_to_the_endpoint_that_answers(server):
+  reports = []
+  live = server.address
+  client, endpoint, seconds = ds_endpoints.race([('127.0.0.1', _closed_port()), live], 2.0,
+                                                report=lambda *item: reports.append(item))
+  client.close()
+  assert endpoint == live
+  assert seconds >= 0.0
+  assert (live, seconds) in reports
@@ -0,0 +1,67 @@
+import pytest
+
+import ds_ingest
+from ds_messenger import Message
+
+
+def _key(n:int) -> bytes:
+  return ds_ingest.message_key(Message('bob', float(n), f'message {n}'))
+
+
+def test_message_key_covers_every_field():
+  msg = Message('bob', 1.0, 'hi', 'alice')
+  assert ds_ingest.message_key(msg) == ds_ingest.message_key(Message('bob', 1.0, 'hi', 'alice'))
+  for other in (Message('carol', 1.0, 'hi', 'alice'), Message('bob', 2.0, 'hi', 'alice'),
+                Message('bob', 1.0, 'ho', 'alice'), Message('bob', 1.0, 'hi', 'dave'), Message('bob', 1.0, 'hi')):
+    assert ds_ingest.message_key(other) != ds_ingest.message_key(msg)
+
+
+def test_recent_set_forgets_the_least_recently_seen():
+  seen = ds_ingest.RecentSet(3)
+  assert all(seen.add(_key(n)) for n in range(3))
+  assert not seen.add(_key(0))
+  assert seen.add(_key(3))
+  assert len(seen) == 3
+  # 1 was the least recently seen, since 0 was seen again.
+  assert seen.add(_key(1))
+  assert not seen.add(_key(0))
+
+
+def test_bloom_filter_has_no_false_negatives():
+  bloom = ds_ingest.BloomFilter(1000)
+  for n in range(0, 1000, 2):
+    bloom.add(_key(n))
+  assert not any(bloom.add(_key(n)) for n in range(0, 1000, 2))
+
+
+def test_bloom_filter_false_positive_rate():
+  bloom = ds_ingest.BloomFilter(10000, 0.01)
+  for n in range(10000):
+    bloom.add(_key(n))
+  false_positives = sum(not bloom.add(_key(n)) for n in range(10000, 20000))
+  assert false_positives < 300
+
+
+def test_bloom_filter_ages_out_old_generations():
+  bloom = ds_ingest.BloomFilter(100)
+  bloom.add(_key(0))
+  for n in range(1, 301):
+    bloom.add(_key(n))
+  assert len(bloom) <= 100
+  # Generations later, the first key is no longer remembered.
+  assert bloom.add(_key(0))
+
+
+def test_deduplicator_filters_repeats():
+  for kind in ('lru', 'bloom'):
+    dedup = ds_ingest.Deduplicator(100, kind)
+    messages = [Message('bob', float(n), 'same body') for n in range(5)]
+    assert list(dedup.filter(messages)) == messages
+    assert list(dedup.filter(messages + [Message('bob', 9.0, 'new')])) == [Message('bob', 9.0, 'new')]
+    assert dedup.accepted == 6
+    assert dedup.duplicates == 5
+
+
+def test_deduplicator_rejects_an_unknown_kind():
+  with pytest.raises(ValueError):
+    ds_ingest.Deduplicator(10, 'cuckoo')
@@ -0,0 +1,194 @@
+import json
+import socket
+import time
+
+import pytest
+
+import ds_messenger as dsm
+import ds_server
+
+MESSAGES = [
+  {'message': 'plain', 'from': 'bob', 'timestamp': '1.5'},
+  {'message': 'café ✓ 日本語', 'from': 'böb', 'timestamp': '2.5'},
+  {'message': 'brackets ] and [ and "quotes", commas', 'from': 'carol', 'timestamp': '3.5'},
+  {'message': 'emoji \U0001f600', 'from': 'dave', 'timestamp': '4.5'},
+]
+
+
+"""
+A DirectMessage attached to one end of a socket pair, and the other end to play the server with.
+"""
+@pytest.fixture
+def pair():
+  client, peer = socket.socketpair()
+  session = dsm.DirectMessage()
+  session._attach(client, 2.0)
+  yield session, peer
+  session.close()
+  peer.close()
+
+
+def _line(response:dict) -> bytes:
+  # Written unescaped, so non-ASCII text reaches the decoder as multi-byte UTF-8.
+  return (json.dumps(response, ensure_ascii=False) + '\r\n').encode()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 65536])
+def test_read_messages_across_chunk_boundaries(pair, chunk_size):
+  session, peer = pair
+  line = _line({'response': {'type': 'ok', 'messages': MESSAGES}})
+  peer.sendall(line)
+  assert list(session._read_messages(chunk_size)) == MESSAGES
+  assert session.last_read_size == len(line)
+
+
+def test_read_messages_empty_list(pair):
+  session, peer = pair
+  peer.sendall(_line({'response': {'type': 'ok', 'messages': []}}))
+  assert list(session._read_messages(4)) == []
+
+
+def test_read_messages_error_response(pair):
+  session, peer = pair
+  peer.sendall(_line({'response': {'type': 'error', 'message': 'Invalid user token.'}}))
+  peer.sendall(_line({'response': {'type': 'ok', 'message': 'next'}}))
+  with pytest.raises(dsm.ProtocolError, match='Invalid user token.'):
+    list(session._read_messages(5))
+  assert session._read_command()['response']['message'] == 'next'
+
+
+def test_read_messages_closed_early_drains_the_response(pair):
+  session, peer = pair
+  many = [{'message': f'message {i} é', 'from': 'bob', 'timestamp': str(i)} for i in range(200)]
+  line = _line({'response': {'type': 'ok', 'messages': many}})
+  peer.sendall(line + _line({'response': {'type': 'ok', 'message': 'next'}}))
+  messages = session._read_messages(16)
+  assert next(messages) == many[0]
+  messages.close()
+  assert session.last_read_size == len(line)
+  assert session._read_command()['response']['message'] == 'next'
+
+
+def test_read_messages_connection_closed_midway(pair):
+  session, peer = pair
+  line = _line({'response': {'type': 'ok', 'messages': MESSAGES}})
+  peer.sendall(line[:len(line) // 2])
+  peer.close()
+  with pytest.raises(ConnectionResetError):
+    list(session._read_messages(8))
+
+
+def test_read_command_counts_bytes(pair):
+  session, peer = pair
+  line = _line({'response': {'type': 'ok', 'message': '日本語'}})
+  peer.sendall(line)
+  session._read_command()
+  assert session.last_read_size == len(line)
+
+
+def test_closed_direct_message_connects_again(server):
+  host, port = server.address
+  session = dsm.DirectMessage()
+  assert not session.is_connected()
+  session.connection(host, port)
+  session.join('alice', 'pw')
+  session.close()
+  assert not session.is_connected()
+  session.connection(host, port)
+  session.join('alice', 'pw')
+  assert session.is_alive()
+  session.close()
+
+
+def test_send_and_retrieve(server):
+  host, port = server.address
+  alice = dsm.DirectMessenger(host, 'alice', 'pw', port)
+  bob = dsm.DirectMessenger(host, 'bob', 'pw', port)
+  try:
+    assert alice.send('café ✓', 'bob')
+    assert alice.send('second', 'bob')
+    new = bob.retrieve_new()
+    assert [msg.body for msg in new] == ['café ✓', 'second']
+    assert all(msg.sender == 'alice' for msg in new)
+    assert bob.retrieve_new() == []
+    assert list(bob.iter_all()) == bob.retrieve_all() == new
+  finally:
+    alice.close()
+    bob.close()
+
+
+def test_iter_all_closed_early_keeps_the_session():
+  with ds_server.DSPServer(history_size=500) as server:
+    host, port = server.address
+    messenger = dsm.DirectMessenger(host, 'alice', 'pw', port)
+    try:
+      messages = messenger.iter_all()
+      first = [next(messages) for _ in range(3)]
+      messages.close()
+      assert messenger.send('still usable', 'bob')
+      history = messenger.retrieve_all()
+      assert len(history) == 500
+      assert history[:3] == first
+    finally:
+      messenger.close()
+
+
+def test_send_many_gives_equal_bodies_distinct_timestamps(server, monkeypatch):
+  host, port = server.address
+  alice = dsm.DirectMessenger(host, 'alice', 'pw', port)
+  bob = dsm.DirectMessenger(host, 'bob', 'pw', port)
+  try:
+    # A clock that does not move, as on a platform with a coarse timer.
+    monkeypatch.setattr(dsm.time, 'time', lambda: 1700000000.0)
+    assert alice.send_many([('same', 'bob')] * 5, batch_size=2) == [True] * 5
+    monkeypatch.undo()
+    timestamps = [msg.timestamp for msg in bob.retrieve_new()]
+    assert len(timestamps) == 5
+    assert all(a < b for a, b in zip(timestamps, timestamps[1:]))
+  finally:
+    alice.close()
+    bob.close()
+
+
+def test_send_many_reports_rejected_messages(server):
+  host, port = server.address
+  alice = dsm.DirectMessenger(host, 'alice', 'pw', port)
+  try:
+    token = alice.token
+    assert alice.send_many([('one', 'bob'), ('two', 'bob')]) == [True, True]
+    alice.token = 'not a token'
+    assert alice.send_many([('three', 'bob')]) == [False]
+    alice.token = token
+  finally:
+    alice.close()
+
+
+def test_send_is_not_repeated_after_a_read_timeout(server):
+  host, port = server.address
+  alice = dsm.DirectMessenger(host, 'alice', 'pw', port, read_timeout=0.2)
+  bob = dsm.DirectMessenger(host, 'bob', 'pw', port)
+  try:
+    server.latency = 0.5
+    with pytest.raises(dsm.ServerTimeoutError):
+      alice.send('once', 'bob')
+    time.sleep(0.6)
+    server.latency = 0.0
+    assert alice.send('twice', 'bob')
+    assert [msg.body for msg in bob.retrieve_new()] == ['once', 'twice']
+  finally:
+    alice.close()
+    bob.close()
+
+
+def test_send_many_timeout_reports_the_answered_part(server):
+  host, port = server.address
+  alice = dsm.DirectMessenger(host, 'alice', 'pw', port, read_timeout=0.2)
+  try:
+    assert alice.send_many([('first', 'bob')]) == [True]
+    server.latency = 0.5
+    with pytest.raises(dsm.ServerTimeoutError) as e:
+      alice.send_many([('a', 'bob'), ('b', 'bob'), ('c', 'bob')], batch_size=2)
+    assert e.value.answered == []
+  finally:
+    server.latency = 0.0
+    alice.close()
@@ -0,0 +1,23 @@
+import random
+
+import ds_bench
+import ds_metrics
+
+
+def test_histogram_percentiles_are_interpolated():
+  random.seed(1)
+  values = [random.uniform(0.010, 0.030) for _ in range(10000)]
+  histogram = ds_metrics.Histogram()
+  for value in values:
+    histogram.observe(value)
+  for p in (50, 90, 99):
+    exact = ds_bench.percentile(values, p)
+    assert abs(histogram.percentile(p) - exact) / exact < 0.15
+
+
+def test_histogram_percentiles_stay_within_min_and_max():
+  histogram = ds_metrics.Histogram()
+  histogram.observe(0.005)
+  summary = histogram.as_dict()
+  assert summary['p50_ms'] == summary['p99_ms'] == summary['min_ms'] == summary['max_ms'] == 5.0
+  assert ds_metrics.Histogram().as_dict()['p50_ms'] is None
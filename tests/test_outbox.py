@@ -0,0 +1,78 @@
+import pytest
+
+import ds_messenger as dsm
+import ds_outbox
+import ds_store
+
+
+@pytest.fixture
+def queue():
+  store = ds_store.MessageStore(':memory:')
+  yield ds_outbox.OutboundQueue(store, 'alice@local')
+  store.close()
+
+
+"""
+Stands in for DirectMessenger.send_many: answers from a list of results, and fails with an
+error carrying `answered` after answering `fail_after` messages, if set.
+"""
+class FakeMessenger:
+  def __init__(self, results=None, fail_after=None):
+    self.results = results
+    self.fail_after = fail_after
+    self.sent = []
+
+  def send_many(self, messages, batch_size=100):
+    answered = []
+    for item in messages:
+      if self.fail_after is not None and len(self.sent) >= self.fail_after:
+        error = dsm.ServerTimeoutError('The server did not answer in time.')
+        error.answered = answered
+        raise error
+      self.sent.append(item)
+      answered.append(self.results[len(self.sent) - 1] if self.results else True)
+    return answered
+
+
+def test_flush_sends_in_order_and_empties_the_queue(queue, server):
+  for n in range(5):
+    queue.enqueue(f'message {n}', 'bob', float(n + 1))
+  host, port = server.address
+  alice = dsm.DirectMessenger(host, 'alice', 'pw', port)
+  bob = dsm.DirectMessenger(host, 'bob', 'pw', port)
+  try:
+    sent, rejected = queue.flush(alice)
+    assert rejected == []
+    assert sent == [('bob', f'message {n}', float(n + 1)) for n in range(5)]
+    assert queue.depth() == 0
+    assert [(msg.body, msg.timestamp) for msg in bob.retrieve_new()] == [(f'message {n}', float(n + 1)) for n in range(5)]
+  finally:
+    alice.close()
+    bob.close()
+
+
+def test_flush_drops_and_returns_rejected_messages(queue):
+  for n in range(3):
+    queue.enqueue(f'message {n}', 'bob', float(n))
+  sent, rejected = queue.flush(FakeMessenger([True, False, True]))
+  assert [row[1] for row in sent] == ['message 0', 'message 2']
+  assert rejected == [('bob', 'message 1', 1.0)]
+  assert queue.depth() == 0
+
+
+def test_flush_failure_keeps_the_unanswered_messages(queue):
+  queue.BATCH_SIZE = 2
+  for n in range(5):
+    queue.enqueue(f'message {n}', 'bob', float(n))
+  with pytest.raises(dsm.ServerTimeoutError) as e:
+    queue.flush(FakeMessenger([True, True, False, True], fail_after=3))
+  sent, rejected = e.value.flushed
+  assert [row[1] for row in sent] == ['message 0', 'message 1']
+  assert rejected == [('bob', 'message 2', 2.0)]
+  assert queue.depth() == 2
+
+  # The rest goes out with the timestamps it was queued with.
+  messenger = FakeMessenger()
+  sent, rejected = queue.flush(messenger)
+  assert messenger.sent == [('message 3', 'bob', 3.0), ('message 4', 'bob', 4.0)]
+  assert queue.depth() == 0
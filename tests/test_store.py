@@ -0,0 +1,56 @@
+import sqlite3
+
+import pytest
+
+import ds_store
+from ds_messenger import Message
+
+
+@pytest.fixture
+def store():
+  store = ds_store.MessageStore(':memory:')
+  yield store
+  store.close()
+
+
+def test_messages_are_identified_with_their_recipient(store):
+  messages = [Message('alice', 1.0, 'hi', 'bob'), Message('alice', 1.0, 'hi', 'carol'),
+              Message('alice', 2.0, 'note', 'alice'), Message('alice', 2.0, 'note')]
+  assert store.add_messages('a', messages) == messages
+  assert store.add_messages('a', messages) == []
+  assert len(store.load('a')) == 4
+
+
+def test_load_batches_stops_at_until(store):
+  store.add_messages('a', [Message('bob', float(n), f'message {n}') for n in range(5)])
+  until = store.last_id()
+  batches = store.load_batches('a', 2, until)
+  loaded = next(batches)
+  store.add_messages('a', [Message('alice', 9.0, 'sent meanwhile', 'bob')])
+  for batch in batches:
+    loaded.extend(batch)
+  assert [msg.body for msg in loaded] == [f'message {n}' for n in range(5)]
+
+
+def test_remove_messages_also_leaves_the_search_index(store):
+  store.add_messages('a', [Message('alice', 1.0, 'rejected words', 'bob'), Message('bob', 2.0, 'kept words')])
+  assert store.remove_messages('a', [Message('alice', 1.0, 'rejected words', 'bob')]) == 1
+  assert [msg.body for msg in store.search('a', 'words')] == ['kept words']
+
+
+def test_old_store_is_migrated(tmp_path):
+  path = str(tmp_path / 'messages.db')
+  db = sqlite3.connect(path)
+  db.executescript('''
+    CREATE TABLE messages (id INTEGER PRIMARY KEY, account TEXT NOT NULL, sender TEXT NOT NULL,
+      message TEXT NOT NULL, timestamp REAL NOT NULL, UNIQUE (account, sender, timestamp, message));
+    INSERT INTO messages VALUES (7, 'a', 'bob', 'hello from before', 1.0);
+  ''')
+  db.close()
+  store = ds_store.MessageStore(path)
+  try:
+    assert [msg.body for msg in store.search('a', 'hello')] == ['hello from before']
+    added = store.add_messages('a', [Message('alice', 2.0, 'x', 'bob'), Message('alice', 2.0, 'x', 'carol')])
+    assert len(added) == 2
+  finally:
+    store.close()